@@ -0,0 +1,126 @@
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from search_index import tokenize
+from vector_store import HashingVectorizer
+
+# Сколько ответов хранить в кэше
+CACHE_MAX_ENTRIES = 1000
+# Время жизни ответа в кэше (сек)
+CACHE_TTL = 6 * 3600
+# Порог косинусной близости вопросов для совпадения "почти дубликатов"
+NEAR_DUPLICATE_THRESHOLD = 0.9
+
+
+def normalize_question(question: str) -> str:
+    """Normalize a question so that case, punctuation and word forms don't matter."""
+    return " ".join(tokenize(question))
+
+
+class AnswerCache:
+    """
+    LRU cache of generated answers with TTL. Answers are keyed on the normalized
+    question, ids of the retrieved chunks and the system prompt type; questions
+    worded slightly differently can match by embedding similarity within the
+    same chunks/prompt scope. Changing the knowledge base version drops everything.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL,
+                 near_duplicate_threshold: Optional[float] = NEAR_DUPLICATE_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.embedder = HashingVectorizer(dim=256) if near_duplicate_threshold else None
+        self.version = None
+        # key -> (answer, expires_at, scope, question_vector)
+        self.entries: "OrderedDict[str, Tuple]" = OrderedDict()
+        # scope -> {key: question_vector}
+        self.scopes: Dict[str, Dict[str, np.ndarray]] = {}
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _scope(chunk_ids: List[int], system_prompt_type: str) -> str:
+        return f"{system_prompt_type}:{','.join(str(i) for i in chunk_ids)}"
+
+    @staticmethod
+    def _key(normalized: str, scope: str) -> str:
+        return hashlib.sha1(f"{scope}|{normalized}".encode("utf-8")).hexdigest()
+
+    def set_version(self, version: Optional[str]):
+        """Invalidate all answers when the knowledge base was rebuilt."""
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def clear(self):
+        self.entries.clear()
+        self.scopes.clear()
+
+    def _remove(self, key: str):
+        _, _, scope, _ = self.entries.pop(key)
+        scope_entries = self.scopes.get(scope)
+        if scope_entries is not None:
+            scope_entries.pop(key, None)
+            if not scope_entries:
+                del self.scopes[scope]
+
+    def get(self, question: str, chunk_ids: List[int], system_prompt_type: str) -> Optional[str]:
+        normalized = normalize_question(question)
+        scope = self._scope(chunk_ids, system_prompt_type)
+        key = self._key(normalized, scope)
+        now = time.monotonic()
+
+        entry = self.entries.get(key)
+        if entry is None and self.embedder is not None and self.scopes.get(scope):
+            # Ищем близкий по смыслу вопрос с тем же контекстом
+            query_vector = self.embedder.encode([normalized])[0]
+            candidates = self.scopes[scope]
+            keys = list(candidates)
+            similarities = np.vstack([candidates[k] for k in keys]) @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.near_duplicate_threshold:
+                key = keys[best]
+                entry = self.entries[key]
+                self.near_hits += 1
+
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry[1] < now:
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, question: str, chunk_ids: List[int], system_prompt_type: str, answer: str):
+        normalized = normalize_question(question)
+        scope = self._scope(chunk_ids, system_prompt_type)
+        key = self._key(normalized, scope)
+        if key in self.entries:
+            self._remove(key)
+
+        vector = self.embedder.encode([normalized])[0] if self.embedder is not None else None
+        self.entries[key] = (answer, time.monotonic() + self.ttl, scope, vector)
+        if vector is not None:
+            self.scopes.setdefault(scope, {})[key] = vector
+
+        while len(self.entries) > self.max_entries:
+            self._remove(next(iter(self.entries)))
+
+    def stats(self) -> Dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0
+        }
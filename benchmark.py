@@ -0,0 +1,302 @@
+import asyncio
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from data_loader import DataLoader
+from document_processor import DocumentProcessor
+from metrics import percentile
+
+# Словарь для синтетического корпуса: продукты, термины о здоровье и бизнесе
+PRODUCTS = ["Эльбифид", "Сорбент", "Эпам", "Синхровит", "Адаптовит", "Агатовый бальзам",
+            "Чай", "Облепиха", "Истоки чистоты", "Трансфер фактор", "Новомин", "Цитомин"]
+HEALTH = ["желудок", "печень", "иммунитет", "давление", "сон", "суставы", "кожа", "сосуды",
+          "кишечник", "витамины", "минералы", "воспаление", "гастрит", "аллергия", "простуда"]
+BUSINESS = ["партнер", "кэшбэк", "баллы", "статус", "клуб", "регистрация", "бонус",
+            "структура", "наставник", "доход", "маркетинг", "покупка", "скидка"]
+FILLER = ["рекомендуется", "принимать", "курс", "месяц", "день", "утром", "вечером", "после",
+          "еды", "капли", "таблетки", "раза", "помогает", "поддерживает", "улучшает", "снижает",
+          "компания", "программа", "каждый", "можно", "нужно", "важно", "результат", "эффект"]
+QUESTION_TEMPLATES = ["как принимать {p}", "что помогает при {h}", "{p} и {h}",
+                      "как получить {b}", "что такое {b}", "сколько стоит {p}", "{h} курс лечения"]
+
+
+def summarize(latencies: List[float], elapsed: float) -> Dict:
+    """Latency percentiles (ms) and throughput for a series of operations."""
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+        "throughput_per_s": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss: килобайты в Linux, байты в macOS
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def generate_document(rng: random.Random, chars: int) -> str:
+    paragraphs = []
+    size = 0
+    while size < chars:
+        words = []
+        for _ in range(rng.randint(20, 60)):
+            pool = rng.choice((PRODUCTS, HEALTH, BUSINESS, FILLER, FILLER))
+            words.append(rng.choice(pool).lower())
+        paragraph = " ".join(words).capitalize() + "."
+        paragraphs.append(paragraph)
+        size += len(paragraph)
+    return "\n\n".join(paragraphs)
+
+
+def generate_corpus(data_dir: str, documents: int, chars: int, seed: int):
+    """Write synthetic Russian text documents into data_dir/text."""
+    rng = random.Random(seed)
+    text_dir = os.path.join(data_dir, "text")
+    os.makedirs(text_dir, exist_ok=True)
+    for i in range(documents):
+        with open(os.path.join(text_dir, f"synthetic_{i:05d}.txt"), 'w', encoding='utf-8') as f:
+            f.write(generate_document(rng, chars))
+
+
+def generate_queries(count: int, seed: int) -> List[str]:
+    rng = random.Random(seed + 1)
+    return [
+        rng.choice(QUESTION_TEMPLATES).format(p=rng.choice(PRODUCTS), h=rng.choice(HEALTH), b=rng.choice(BUSINESS))
+        for _ in range(count)
+    ]
+
+
+def load_queries(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+async def bench_ingestion(data_dir: str) -> Dict:
+    loader = DataLoader(data_dir)
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        documents = await loader.process_directory()
+    elapsed = time.perf_counter() - started
+    return {
+        "documents": len(documents),
+        "chunks": len(loader.index.chunks),
+        "seconds": elapsed,
+    }
+
+
+def bench_retrieval(data_dir: str, queries: List[str], modes: List[str]) -> Dict:
+    loader = DataLoader(data_dir)
+    results = {}
+    for mode in modes:
+        latencies = []
+        started = time.perf_counter()
+        for query in queries:
+            query_started = time.perf_counter()
+            loader.search_chunks(query, mode=mode)
+            latencies.append(time.perf_counter() - query_started)
+        results[mode] = summarize(latencies, time.perf_counter() - started)
+    return results
+
+
+async def bench_pdf(pdf_path: str, repeats: int) -> Dict:
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(repeats):
+        job_started = time.perf_counter()
+        text = await DocumentProcessor.process_pdf(pdf_path)
+        latencies.append(time.perf_counter() - job_started)
+    result = summarize(latencies, time.perf_counter() - started)
+    result.update(file=os.path.basename(pdf_path), chars=len(text))
+    return result
+
+
+class StubLLM:
+    """LLM client replacement with a fixed time to first token and streaming speed."""
+
+    def __init__(self, latency: float, tokens: int = 50, token_interval: float = 0.005):
+        self.latency = latency
+        self.tokens = tokens
+        self.token_interval = token_interval
+
+    async def complete(self, messages, **params) -> str:
+        await asyncio.sleep(self.latency + self.tokens * self.token_interval)
+        return "ответ " * self.tokens
+
+    async def stream(self, messages, **params):
+        await asyncio.sleep(self.latency)
+        for _ in range(self.tokens):
+            await asyncio.sleep(self.token_interval)
+            yield "ответ "
+
+
+class FakeSentMessage:
+    async def edit_text(self, text, parse_mode=None):
+        await asyncio.sleep(0)
+        return self
+
+    async def delete(self):
+        await asyncio.sleep(0)
+        return True
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+
+
+class FakeMessage:
+    """Minimal stand-in for aiogram Message used by the text handlers."""
+
+    def __init__(self, text: str, user_id: int):
+        self.text = text
+        self.from_user = FakeUser(user_id)
+        self.chat = FakeUser(user_id)
+        self.sent = 0
+        self.errors: List[str] = []
+
+    async def answer(self, text, parse_mode=None, **kwargs):
+        self.sent += 1
+        # Обработчик сообщает об ошибке ответом пользователю - такой запуск не должен попасть в замер
+        if text.startswith("Произошла ошибка") or text.startswith("Сейчас слишком много запросов"):
+            self.errors.append(text)
+        await asyncio.sleep(0)
+        return FakeSentMessage()
+
+
+async def bench_handlers(data_dir: str, queries: List[str], messages: int, concurrency: int,
+                         llm_latency: float, use_cache: bool) -> Dict:
+    from aiogram.fsm.context import FSMContext
+    from aiogram.fsm.storage.base import StorageKey
+    from aiogram.fsm.storage.memory import MemoryStorage
+    import generate
+    import handlers
+    from answer_cache import AnswerCache
+    from extraction_cache import EXTRACTION_CACHE_FILE
+    from session_store import STATE_DB_FILE
+
+    # Тестовые пользователи не должны попасть в рабочие базы: хранилища во временной директории
+    state_dir = os.path.join(data_dir, "bench_state")
+    os.makedirs(state_dir, exist_ok=True)
+    handlers.init_stores(os.path.join(state_dir, STATE_DB_FILE), os.path.join(state_dir, EXTRACTION_CACHE_FILE))
+
+    generate.client = StubLLM(llm_latency)
+    if not use_cache:
+        generate.answer_cache = AnswerCache(max_entries=0, near_duplicate_threshold=None)
+    handlers.set_data_loader(DataLoader(data_dir))
+    storage = MemoryStorage()
+
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        user_id = 1000 + i
+        message = FakeMessage(queries[i % len(queries)], user_id)
+        state = FSMContext(storage=storage, key=StorageKey(bot_id=1, chat_id=user_id, user_id=user_id))
+        async with semaphore:
+            started = time.perf_counter()
+            await handlers.handle_message(message, state)
+            latencies.append(time.perf_counter() - started)
+        if message.errors:
+            raise RuntimeError(f"Handler replied with an error: {message.errors[0]}")
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        await asyncio.gather(*(one(i) for i in range(messages)))
+    result = summarize(latencies, time.perf_counter() - started)
+    result.update(concurrency=concurrency, llm_latency_s=llm_latency, cache=use_cache)
+    return result
+
+
+def compare(current: Dict, baseline: Dict, prefix: str = ""):
+    """Print metrics that differ from a previous run."""
+    for key, value in current.items():
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            compare(value, old or {}, name + ".")
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            change = (value - old) / old * 100
+            print(f"  {name:<45} {old:>12.3f} -> {value:>12.3f}  ({change:+.1f}%)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска, обработки документов и обработчиков бота.')
+    parser.add_argument('--docs', type=int, default=200, help='Количество синтетических документов')
+    parser.add_argument('--doc-chars', type=int, default=5000, help='Размер синтетического документа в символах')
+    parser.add_argument('--queries', type=int, default=500, help='Количество синтетических запросов')
+    parser.add_argument('--query-log', type=str, default=None, help='Файл с реальными запросами (по одному на строку)')
+    parser.add_argument('--modes', type=str, default='bm25,vector,hybrid', help='Режимы поиска через запятую')
+    parser.add_argument('--pdf', type=str, default=os.path.join('training_data', 'pdf', 'Справочник здоровья SW.pdf'),
+                        help='PDF для замера извлечения текста')
+    parser.add_argument('--pdf-repeats', type=int, default=3, help='Сколько раз обрабатывать PDF')
+    parser.add_argument('--messages', type=int, default=200, help='Количество сообщений для обработчиков')
+    parser.add_argument('--concurrency', type=int, default=20, help='Одновременных пользователей')
+    parser.add_argument('--llm-latency', type=float, default=0.2, help='Время до первого токена заглушки LLM (сек)')
+    parser.add_argument('--cache', action='store_true', help='Включить кэш ответов при замере обработчиков')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=str, default='bench_results.json', help='Файл для результатов')
+    parser.add_argument('--compare', type=str, default=None, help='Сравнить с результатами предыдущего запуска')
+    args = parser.parse_args()
+
+    queries = load_queries(args.query_log) if args.query_log else generate_queries(args.queries, args.seed)
+    results = {"config": vars(args), "started_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+    data_dir = tempfile.mkdtemp(prefix="bench_kb_")
+    try:
+        print(f"Генерация корпуса: {args.docs} документов по {args.doc_chars} символов")
+        generate_corpus(data_dir, args.docs, args.doc_chars, args.seed)
+
+        print("Замер индексации корпуса...")
+        results["ingestion"] = await bench_ingestion(data_dir)
+
+        print(f"Замер поиска: {len(queries)} запросов")
+        results["retrieval"] = bench_retrieval(data_dir, queries, args.modes.split(','))
+
+        if args.pdf and os.path.exists(args.pdf):
+            print(f"Замер извлечения текста из {args.pdf}")
+            results["pdf"] = await bench_pdf(args.pdf, args.pdf_repeats)
+
+        print(f"Замер обработчиков: {args.messages} сообщений, {args.concurrency} одновременно")
+        results["handlers"] = await bench_handlers(data_dir, queries, args.messages, args.concurrency,
+                                                   args.llm_latency, args.cache)
+    finally:
+        DocumentProcessor.shutdown()
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    print("\n=== Результаты ===")
+    print(json.dumps({k: v for k, v in results.items() if k != "config"}, ensure_ascii=False, indent=2))
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nРезультаты сохранены в {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\n=== Сравнение с {args.compare} ===")
+        compare({k: v for k, v in results.items() if k not in ("config", "started_at")}, baseline)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,128 @@
+import re
+from typing import Dict, List, Optional, Tuple, Union
+
+# Размер контекстного окна моделей (в токенах)
+MODEL_CONTEXT_WINDOWS = {
+    "meta-llama/llama-3.3-8b-instruct:free": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Запас на служебные токены чата и погрешность оценки
+SAFETY_MARGIN = 256
+# Не добавлять обрезанный фрагмент, если на него остается меньше токенов
+MIN_PARTIAL_TOKENS = 120
+# Доля строк фрагмента, уже попавших в контекст, при которой он считается дубликатом
+DUPLICATE_LINE_RATIO = 0.8
+
+# Символов на токен по классам символов: консервативная оценка для токенизатора Llama 3
+# на текстах базы знаний (лучше переоценить размер промпта, чем выйти за окно)
+CHARS_PER_TOKEN = (
+    (re.compile(r"[а-яёА-ЯЁ]"), 2.6),
+    (re.compile(r"[a-zA-Z]"), 4.0),
+    (re.compile(r"[0-9]"), 1.5),
+    (re.compile(r"\s"), 6.0),
+)
+
+
+def count_tokens(text: str) -> int:
+    """Estimate the number of tokens from character classes."""
+    if not text:
+        return 0
+    tokens = 0.0
+    remaining = len(text)
+    for pattern, chars_per_token in CHARS_PER_TOKEN:
+        count = len(pattern.findall(text))
+        tokens += count / chars_per_token
+        remaining -= count
+    # Пунктуация и прочие символы - примерно токен на символ
+    return int(tokens + remaining) + 1
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text to roughly max_tokens, preferring a line boundary."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    cut = text.rfind("\n", 0, low)
+    return text[:cut if cut > low // 2 else low].rstrip()
+
+
+def format_chunks(chunks: List[Dict]) -> Optional[str]:
+    """Concatenate chunks with their source headers."""
+    if not chunks:
+        return None
+    context = []
+    for chunk in chunks:
+        context.append(f"--- Информация из {chunk['source']} ---\n{chunk['text']}\n")
+    return "\n".join(context)
+
+
+def _normalized_lines(text: str) -> List[str]:
+    return [" ".join(line.lower().split()) for line in text.splitlines() if line.strip()]
+
+
+def deduplicate(chunks: List[Dict]) -> List[Dict]:
+    """Drop chunks whose lines are (almost) all contained in higher-ranked chunks."""
+    seen_lines = set()
+    unique = []
+    for chunk in chunks:
+        lines = _normalized_lines(chunk["text"])
+        if not lines:
+            continue
+        repeated = sum(1 for line in lines if line in seen_lines)
+        if repeated / len(lines) >= DUPLICATE_LINE_RATIO:
+            continue
+        seen_lines.update(lines)
+        unique.append(chunk)
+    return unique
+
+
+def context_budget(model: str, max_tokens: int, fixed_text: str = "") -> int:
+    """Tokens left for context after the answer reservation and the fixed part of the prompt."""
+    window = MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+    return max(0, window - max_tokens - SAFETY_MARGIN - count_tokens(fixed_text))
+
+
+def build_context(context: Union[str, List[Dict], None], budget: int) -> Tuple[Optional[str], Dict]:
+    """
+    Assemble context within a token budget: chunks are deduplicated,
+    ordered by score and added while they fit; the last one may be cut.
+    Returns the context string and a report about what was included.
+    """
+    report = {"budget": budget, "context_tokens": 0, "chunks_used": 0, "chunks_dropped": 0, "truncated": False}
+    if not context:
+        return None, report
+
+    if isinstance(context, str):
+        chunks = [{"text": context, "source": None, "score": 0.0}]
+    else:
+        chunks = sorted(context, key=lambda chunk: chunk.get("score", 0.0), reverse=True)
+        deduplicated = deduplicate(chunks)
+        report["chunks_dropped"] = len(chunks) - len(deduplicated)
+        chunks = deduplicated
+
+    parts = []
+    used = 0
+    for position, chunk in enumerate(chunks):
+        header = f"--- Информация из {chunk['source']} ---\n" if chunk.get("source") else ""
+        part = f"{header}{chunk['text']}\n"
+        tokens = count_tokens(part)
+        if used + tokens > budget:
+            remaining = budget - used - count_tokens(header)
+            if remaining >= MIN_PARTIAL_TOKENS:
+                parts.append(f"{header}{truncate_to_tokens(chunk['text'], remaining)}\n")
+                used = budget
+                report["truncated"] = True
+            report["chunks_dropped"] += len(chunks) - position - (1 if report["truncated"] else 0)
+            break
+        parts.append(part)
+        used += tokens
+
+    report["chunks_used"] = len(parts)
+    report["context_tokens"] = used
+    return ("\n".join(parts) if parts else None), report
@@ -0,0 +1,161 @@
+import asyncio
+import re
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from context_builder import count_tokens
+from data_loader import SEARCH_TOP_K, CONTEXT_MAX_CHARS
+from scheduler import GenerationScheduler, QueueDropped, PRIORITY_BACKGROUND
+from session_store import ConversationStore
+
+# Бюджет истории в промпте (токенов): сводка и последние реплики, которые в него помещаются
+HISTORY_TOKEN_BUDGET = 1200
+# Сколько последних обменов репликами оставлять дословно, когда старые сворачиваются в сводку
+KEEP_RECENT_TURNS = 2
+# Короткий вопрос без ссылок может быть как уточнением, так и новой темой: его ищем и отдельно,
+# и вместе с предыдущим вопросом
+FOLLOW_UP_MAX_WORDS = 5
+# Вопрос, начинающийся с этих слов ("а сколько стоит?"), продолжает предыдущий
+ELLIPTIC_START_WORDS = {"а", "и"}
+# Слова, которые ссылаются на предмет предыдущего вопроса
+REFERENCE_WORDS = {
+    "он", "она", "оно", "они", "его", "ее", "её", "их", "им", "ним", "нем", "нём", "ней", "них",
+    "этот", "эта", "это", "эти", "этого", "этой", "этих", "этим", "тот", "та", "те", "того", "такой", "такие",
+    "там", "него", "нее", "неё"
+}
+# Все фоновые сводки делят одну очередь, чтобы вместе не занимать больше доли одного пользователя
+SUMMARY_QUEUE = "conversation-summaries"
+
+WORD_RE = re.compile(r"\w+")
+
+
+def is_follow_up(question: str, turns: List[Dict]) -> bool:
+    """
+    Whether the question continues the conversation: it refers to the
+    previous subject ("сколько он стоит?") or starts elliptically ("а ...").
+    Only such questions are answered with the conversation history.
+    """
+    if not turns:
+        return False
+    words = WORD_RE.findall(question.lower())
+    return bool(words) and (words[0] in ELLIPTIC_START_WORDS or bool(REFERENCE_WORDS.intersection(words)))
+
+
+def rewrite_query(question: str, turns: List[Dict]) -> List[str]:
+    """
+    Search queries for a question given recent turns. A follow-up is searched
+    together with the previous question so that retrieval finds its subject;
+    a short question without references may be a new topic, so it is searched
+    both as is and together with the previous question. No model call is made.
+    """
+    if not turns:
+        return [question]
+    merged = f"{turns[-1]['question']} {question}"
+    if is_follow_up(question, turns):
+        return [merged]
+    if len(WORD_RE.findall(question)) <= FOLLOW_UP_MAX_WORDS:
+        return [question, merged]
+    return [question]
+
+
+def merge_results(results: List[List[Dict]], top_k: int = SEARCH_TOP_K,
+                  max_chars: int = CONTEXT_MAX_CHARS) -> List[Dict]:
+    """
+    Interleave chunk lists found for several queries, best first and without
+    duplicates, within top_k chunks and max_chars characters. The first list
+    leads, so the question's own results are never pushed out by the merged query.
+    """
+    merged = []
+    seen = set()
+    total_chars = 0
+    for rank in range(max((len(chunks) for chunks in results), default=0)):
+        for chunks in results:
+            if rank >= len(chunks) or chunks[rank]["id"] in seen:
+                continue
+            chunk = chunks[rank]
+            if len(merged) >= top_k or (merged and total_chars + len(chunk["text"]) > max_chars):
+                return merged
+            seen.add(chunk["id"])
+            merged.append(chunk)
+            total_chars += len(chunk["text"])
+    return merged
+
+
+def _turn_tokens(turn: Dict) -> int:
+    return count_tokens(turn["question"]) + count_tokens(turn["answer"])
+
+
+class ConversationMemory:
+    """
+    Conversation history for prompts. Recent turns and a rolling summary are
+    kept in ConversationStore; once the stored turns exceed the token budget,
+    all but the last few are summarized by the model in the background at the
+    lowest scheduler priority, so answering never waits for a summary. The
+    prompt gets the summary plus as many recent turns as fit into the budget.
+    """
+
+    def __init__(self, store: Optional[ConversationStore], summarize: Callable[[str, List[Dict]], Awaitable[Optional[str]]],
+                 scheduler: Optional[GenerationScheduler] = None, budget: int = HISTORY_TOKEN_BUDGET,
+                 keep_recent: int = KEEP_RECENT_TURNS):
+        self.store = store
+        self.summarize = summarize
+        self.scheduler = scheduler
+        self.budget = budget
+        self.keep_recent = keep_recent
+        self.summarizing: Set[str] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def load(self, chat: str) -> Tuple[str, List[Dict]]:
+        return await asyncio.to_thread(self.store.get, chat)
+
+    def messages(self, summary: str, turns: List[Dict]) -> List[Dict]:
+        """Prompt messages for the history: the summary first, then the newest turns that fit the budget."""
+        budget = self.budget
+        messages = []
+        if summary:
+            summary_text = f"Краткое содержание предыдущего разговора: {summary}"
+            budget -= count_tokens(summary_text)
+        for turn in reversed(turns):
+            tokens = _turn_tokens(turn)
+            if tokens > budget:
+                break
+            budget -= tokens
+            messages[:0] = [
+                {"role": "user", "content": turn["question"]},
+                {"role": "assistant", "content": turn["answer"]}
+            ]
+        if summary and budget >= 0:
+            messages.insert(0, {"role": "system", "content": summary_text})
+        return messages
+
+    async def remember(self, chat: str, question: str, answer: str):
+        """Store a turn; start summarizing older turns if the history outgrew the budget."""
+        await asyncio.to_thread(self.store.append, chat, question, answer)
+        if chat in self.summarizing:
+            return
+        summary, turns = await self.load(chat)
+        if len(turns) <= self.keep_recent or sum(_turn_tokens(turn) for turn in turns) <= self.budget:
+            return
+        self.summarizing.add(chat)
+        task = asyncio.create_task(self._summarize(chat, summary, turns[:-self.keep_recent]))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _summarize(self, chat: str, summary: str, turns: List[Dict]):
+        try:
+            if self.scheduler is not None:
+                async with self.scheduler.slot(SUMMARY_QUEUE, PRIORITY_BACKGROUND):
+                    new_summary = await self.summarize(summary, turns)
+            else:
+                new_summary = await self.summarize(summary, turns)
+            # Если сводка не получилась, в промпт просто попадут последние реплики
+            if new_summary:
+                await asyncio.to_thread(self.store.set_summary, chat, new_summary, turns[-1]["seq"])
+        except QueueDropped:
+            pass
+        except Exception as e:
+            print(f"Ошибка при сворачивании истории разговора: {e}")
+        finally:
+            self.summarizing.discard(chat)
+
+    async def clear(self, chat: str):
+        await asyncio.to_thread(self.store.clear, chat)
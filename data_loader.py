@@ -1,115 +1,336 @@
 import os
-import json
+import time
+import asyncio
+import hashlib
 from typing import Dict, List, Optional
 from document_processor import DocumentProcessor
+from search_index import SearchIndex, split_into_chunks
+from knowledge_store import KnowledgeStore
+from context_builder import format_chunks
+from metrics import observe_stage
+from extraction_cache import ExtractionCache
+from vector_store import VectorStore, HASHING_EMBEDDER
+
+# Максимальный размер фрагмента документа при индексации
+CHUNK_MAX_CHARS = 1200
+# Сколько фрагментов возвращать при поиске
+SEARCH_TOP_K = 5
+# Бюджет контекста в символах, передаваемого в модель
+CONTEXT_MAX_CHARS = 6000
+# Режим поиска: "bm25", "vector" или "hybrid"
+RETRIEVER_MODE = "hybrid"
+# Вес векторной близости в гибридной оценке
+HYBRID_ALPHA = 0.5
+# Минимальная косинусная близость для кандидатов из векторного поиска
+VECTOR_MIN_SCORE = 0.2
+
+# Поддиректории с обучающими данными: (папка, тип документа, расширения)
+SOURCE_DIRS = (
+    ("pdf", "pdf", ('.pdf',)),
+    ("images", "image", ('.jpg', '.jpeg', '.png')),
+    ("text", "text", ('.txt',)),
+    # Страницы официального сайта, сохраненные site_crawler.py
+    ("site", "text", ('.txt',)),
+)
 
 class DataLoader:
     def __init__(self, data_dir: str = "training_data"):
         """Initialize data loader with directory for training data."""
         self.data_dir = data_dir
-        self.knowledge_base = {}
+        self.last_report = []
         
         # Create data directory if not exists
         os.makedirs(data_dir, exist_ok=True)
-        os.makedirs(os.path.join(data_dir, "pdf"), exist_ok=True)
-        os.makedirs(os.path.join(data_dir, "images"), exist_ok=True)
-        os.makedirs(os.path.join(data_dir, "text"), exist_ok=True)
+        for subdir, _, _ in SOURCE_DIRS:
+            os.makedirs(os.path.join(data_dir, subdir), exist_ok=True)
         
-        # Knowledge base file path
+        # Knowledge base storage; legacy JSON files are only read for migration
+        self.db_file = os.path.join(data_dir, "knowledge.db")
         self.kb_file = os.path.join(data_dir, "knowledge_base.json")
+        self.manifest_file = os.path.join(data_dir, "manifest.json")
+        
+        # Search index and vector store file paths
+        self.index_file = os.path.join(data_dir, "search_index.bin")
+        self.vector_file = os.path.join(data_dir, "embeddings.npy")
+        
+        # Open the store without reading document contents
+        is_new_store = not os.path.exists(self.db_file)
+        self.store = KnowledgeStore(self.db_file)
+        if is_new_store and os.path.exists(self.kb_file):
+            self.migrate_from_json()
+        
+        # Load prebuilt search index if available
+        self.index = SearchIndex.load(self.index_file)
+        
+        # Memory-map chunk embeddings built by train_bot.py
+        self.vectors = None
+        if self.index is not None:
+            self.vectors = VectorStore.load(self.vector_file, len(self.index.chunks), self.index.version)
+        self.embedder_name = VectorStore.read_embedder_name(self.vector_file) or HASHING_EMBEDDER
+        self._extraction_cache = None
+    
+    @property
+    def extraction_cache(self) -> ExtractionCache:
+        """Cache of text extracted from PDFs and images, opened on first use."""
+        if self._extraction_cache is None:
+            self._extraction_cache = ExtractionCache()
+        return self._extraction_cache
+    
+    def migrate_from_json(self):
+        """Import the legacy knowledge_base.json into the SQLite store."""
+        count = self.store.migrate_from_json(
+            self.kb_file, lambda text: split_into_chunks(text, CHUNK_MAX_CHARS), self.manifest_file
+        )
+        print(f"Migrated {count} documents from {self.kb_file} to {self.db_file}")
+        # Индекс построен по старой нумерации фрагментов
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
+    
+    def _scan_files(self) -> List[Dict]:
+        """List all supported training files with their knowledge base type."""
+        files = []
+        for subdir, doc_type, extensions in SOURCE_DIRS:
+            dir_path = os.path.join(self.data_dir, subdir)
+            for filename in sorted(os.listdir(dir_path)):
+                if filename.lower().endswith(extensions):
+                    files.append({
+                        "path": f"{subdir}/{filename}",
+                        "file_path": os.path.join(dir_path, filename),
+                        "filename": filename,
+                        "type": doc_type
+                    })
+        return files
+    
+    @staticmethod
+    def _file_hash(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    @staticmethod
+    def _read_text_file(file_path: str) -> str:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    
+    async def _extract(self, file: Dict) -> Dict:
+        """Extract text of a single file and measure how long it took."""
+        started = time.perf_counter()
+        print(f"Processing {file['type']}: {file['filename']}")
+        try:
+            if file["type"] in ("pdf", "image"):
+                # Файл с тем же содержимым уже обрабатывался (переименован, перемещен или база очищена)
+                text = await asyncio.to_thread(self.extraction_cache.get, file["sha256"], file["type"])
+                if text is None:
+                    text, complete = await DocumentProcessor.extract(file["file_path"], file["type"])
+                    # Текст с ошибками OCR не кэшируем, чтобы при следующей обработке повторить распознавание
+                    if text and complete:
+                        await asyncio.to_thread(self.extraction_cache.put, file["sha256"], file["type"], text)
+            else:
+                text = await asyncio.to_thread(self._read_text_file, file["file_path"])
+            error = text.startswith("Error processing") if text else False
+        except Exception as e:
+            text, error = f"Error processing file: {str(e)}", True
+        return {
+            "file": file,
+            "text": text,
+            "error": error,
+            "seconds": time.perf_counter() - started
+        }
+    
+    async def process_directory(self, jobs: Optional[int] = None) -> Dict:
+        """
+        Incrementally process training data in the directory.
+        Only new or changed files (by size, mtime and content hash) are extracted,
+        concurrently; files removed from disk are purged from the knowledge base.
+        Returns metadata of all documents in the knowledge base.
+        """
+        if jobs:
+            DocumentProcessor.configure(max_workers=jobs)
+        
+        changed = False
+        self.last_report = []
+        files = self._scan_files()
+        documents = self.store.list_documents()
+        to_process = []
+        
+        for file in files:
+            stat = os.stat(file["file_path"])
+            document = documents.get(file["filename"])
+            if (document and document["path"] == file["path"]
+                    and document["size"] == stat.st_size and document["mtime"] == stat.st_mtime):
+                continue
+            
+            file_hash = await asyncio.to_thread(self._file_hash, file["file_path"])
+            file.update(size=stat.st_size, mtime=stat.st_mtime, sha256=file_hash)
+            # Изменилось только время модификации, либо документ был импортирован без данных о файле
+            if document and (document["sha256"] is None or document["sha256"] == file_hash):
+                self.store.update_file_meta(file["filename"], file)
+                continue
+            to_process.append(file)
+        
+        # Purge deleted files tracked by their source path
+        present = {file["path"] for file in files}
+        for name, document in documents.items():
+            if document["path"] and document["path"] not in present:
+                self.store.delete_document(name)
+                self.last_report.append({"file": name, "status": "deleted", "seconds": 0.0, "chars": 0})
+                print(f"Removed deleted file: {name}")
+                changed = True
+        
+        # Extract new and changed files concurrently, storing each one atomically
+        for result in await asyncio.gather(*(self._extract(file) for file in to_process)):
+            file = result["file"]
+            status = "error" if result["error"] else ("updated" if file["filename"] in documents else "added")
+            self.last_report.append({
+                "file": file["filename"], "status": status,
+                "seconds": result["seconds"], "chars": len(result["text"] or "")
+            })
+            if result["error"]:
+                print(f"Error processing {file['filename']}: {result['text']}")
+                continue
+            text = result["text"] or ""
+            self.store.upsert_document(file["filename"], file["type"], text,
+                                       split_into_chunks(text, CHUNK_MAX_CHARS), file)
+            changed = True
         
-        # Load existing knowledge base if available
-        if os.path.exists(self.kb_file):
-            with open(self.kb_file, 'r', encoding='utf-8') as f:
-                self.knowledge_base = json.load(f)
-    
-    async def process_directory(self) -> Dict:
-        """Process all training data in the directory."""
-        # Process PDFs
-        pdf_dir = os.path.join(self.data_dir, "pdf")
-        for filename in os.listdir(pdf_dir):
-            if filename.lower().endswith('.pdf'):
-                file_path = os.path.join(pdf_dir, filename)
-                if filename not in self.knowledge_base:
-                    print(f"Processing PDF: {filename}")
-                    text = await DocumentProcessor.process_pdf(file_path)
-                    if text:
-                        self.knowledge_base[filename] = {
-                            "type": "pdf",
-                            "content": text
-                        }
-        
-        # Process images
-        img_dir = os.path.join(self.data_dir, "images")
-        for filename in os.listdir(img_dir):
-            if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
-                file_path = os.path.join(img_dir, filename)
-                if filename not in self.knowledge_base:
-                    print(f"Processing image: {filename}")
-                    text = await DocumentProcessor.process_image(file_path)
-                    if text:
-                        self.knowledge_base[filename] = {
-                            "type": "image",
-                            "content": text
-                        }
-        
-        # Process text files
-        text_dir = os.path.join(self.data_dir, "text")
-        for filename in os.listdir(text_dir):
-            if filename.lower().endswith('.txt'):
-                file_path = os.path.join(text_dir, filename)
-                if filename not in self.knowledge_base:
-                    print(f"Processing text file: {filename}")
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            text = f.read()
-                            self.knowledge_base[filename] = {
-                                "type": "text",
-                                "content": text
-                            }
-                    except Exception as e:
-                        print(f"Error processing text file {filename}: {str(e)}")
-        
-        # Save updated knowledge base
-        self.save_knowledge_base()
-        return self.knowledge_base
-    
-    def save_knowledge_base(self):
-        """Save knowledge base to file."""
-        with open(self.kb_file, 'w', encoding='utf-8') as f:
-            json.dump(self.knowledge_base, f, ensure_ascii=False, indent=2)
+        # Rebuild search index if documents changed (in a thread, so the event loop keeps serving)
+        if changed or self.index is None:
+            await asyncio.to_thread(self.rebuild_index)
+        return self.store.list_documents()
+    
+    def clear(self):
+        """Remove all documents and rebuild the (empty) index."""
+        self.store.clear()
+        self.rebuild_index()
+    
+    def rebuild_index(self):
+        """Rebuild the inverted index over all stored chunks."""
+        self.index = SearchIndex.build(self.store.iter_chunks())
+        self.index.save(self.index_file)
+        print(f"Search index rebuilt: {len(self.index.chunks)} chunks")
+        self.build_vectors()
+    
+    def build_vectors(self):
+        """Embed all index chunks and save them as a memory-mapped vector store."""
+        # Vector rows follow the order of the index chunks
+        texts_by_id = {chunk_id: text for chunk_id, _, text in self.store.iter_chunks()}
+        texts = [texts_by_id.get(chunk["id"], "") for chunk in self.index.chunks]
+        VectorStore.build(texts, self.vector_file, self.embedder_name, self.index.version)
+        self.vectors = VectorStore.load(self.vector_file, len(texts), self.index.version)
+        print(f"Vector store rebuilt: {len(texts)} vectors ({self.vectors.embedder.name})")
+    
+    def _rank(self, query: str, top_k: int, mode: str, alpha: float = HYBRID_ALPHA,
+              similarities=None) -> List:
+        """
+        Rank chunks with the configured retriever backend. similarities are the
+        query's cosine similarities to all chunks, if already computed.
+        """
+        if mode == "bm25" or self.vectors is None:
+            return self.index.search(query, top_k)
+        
+        if similarities is None:
+            similarities = self.vectors.scores(self.vectors.encode_query(query))
+        if mode == "vector":
+            return [(position, score) for position, score in VectorStore.top_scores(similarities, top_k)
+                    if score >= VECTOR_MIN_SCORE]
+        
+        # Hybrid: blend normalized BM25 with cosine similarity over both candidate sets
+        bm25 = dict(self.index.search(query, top_k * 4))
+        candidates = set(bm25)
+        candidates.update(position for position, score in VectorStore.top_scores(similarities, top_k * 4)
+                          if score >= VECTOR_MIN_SCORE)
+        if not candidates:
+            return []
+        bm25_max = max(bm25.values()) if bm25 else 1.0
+        scored = [
+            (position, alpha * float(similarities[position]) + (1 - alpha) * bm25.get(position, 0.0) / bm25_max)
+            for position in sorted(candidates)
+        ]
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return scored[:top_k]
     
     def get_full_context(self) -> str:
         """Get the full context from all processed files."""
         context = []
-        for filename, data in self.knowledge_base.items():
-            context.append(f"--- Содержимое файла: {filename} ---\n{data['content']}\n")
+        for filename, content in self.store.iter_contents():
+            context.append(f"--- Содержимое файла: {filename} ---\n{content}\n")
         return "\n".join(context)
     
-    def search_knowledge_base(self, query: str) -> Optional[str]:
+    def search_chunks(self, query: str, top_k: int = SEARCH_TOP_K,
+                      max_chars: int = CONTEXT_MAX_CHARS, mode: str = RETRIEVER_MODE,
+                      alpha: float = HYBRID_ALPHA) -> List[Dict]:
         """
-        Simple search function that returns content 
-        from knowledge base that might be relevant to the query
+        Return the best matching chunks for the query,
+        limited to top_k chunks and max_chars characters in total.
         """
-        # This is a very basic implementation
-        # In a real application, you would use vector search or another more sophisticated method
-        query_terms = set(query.lower().split())
-        results = []
-        
-        for filename, data in self.knowledge_base.items():
-            content = data['content'].lower()
-            score = sum(1 for term in query_terms if term in content)
-            if score > 0:
-                results.append((filename, data, score))
+        if self.index is None:
+            self.rebuild_index()
         
-        # Sort by relevance score
-        results.sort(key=lambda x: x[2], reverse=True)
+        started = time.perf_counter()
+        ranked = [(self.index.chunks[position]["id"], score)
+                  for position, score in self._rank(query, top_k, mode, alpha)]
+        chunks = self.store.get_chunks([chunk_id for chunk_id, _ in ranked])
         
-        # Return top relevant contexts concatenated
-        if results:
-            context = []
-            for filename, data, score in results[:3]:  # Top 3 most relevant
-                context.append(f"--- Информация из {filename} ---\n{data['content']}\n")
-            return "\n".join(context)
+        results = []
+        total_chars = 0
+        for chunk_id, score in ranked:
+            chunk = chunks.get(chunk_id)
+            if chunk is None:
+                continue
+            if results and total_chars + len(chunk["text"]) > max_chars:
+                break
+            results.append({
+                "id": chunk_id,
+                "source": chunk["source"],
+                "text": chunk["text"][:max_chars],
+                "score": score
+            })
+            total_chars += len(chunk["text"])
+        observe_stage("retrieval", time.perf_counter() - started)
+        return results
+    
+    def rank_batch(self, queries: List[str], top_k: int = SEARCH_TOP_K, mode: str = RETRIEVER_MODE,
+                   alpha: float = HYBRID_ALPHA, block_size: int = 64) -> List[List[Dict]]:
+        """
+        Rank chunks for many queries, e.g. for retrieval evaluation. Query
+        embeddings are computed in one call per block and their similarities
+        to all chunks with one matrix product. Returns id, source and score of
+        the top_k chunks per query, without the context character budget.
+        """
+        if self.index is None:
+            self.rebuild_index()
         
-        return None 
\ No newline at end of file
+        use_vectors = mode != "bm25" and self.vectors is not None and len(self.vectors.vectors) > 0
+        rankings = []
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            similarities = [None] * len(block)
+            if use_vectors:
+                similarities = (self.vectors.vectors @ self.vectors.embedder.encode(block).T).T
+            for query, query_similarities in zip(block, similarities):
+                rankings.append([
+                    {"id": self.index.chunks[position]["id"], "source": self.index.chunks[position]["source"],
+                     "score": score}
+                    for position, score in self._rank(query, top_k, mode, alpha, query_similarities)
+                ])
+        return rankings
+    
+    @property
+    def version(self) -> Optional[str]:
+        """Version of the search index; changes whenever the knowledge base is rebuilt."""
+        return self.index.version if self.index is not None else None
+    
+    @staticmethod
+    def format_context(chunks: List[Dict]) -> Optional[str]:
+        """Concatenate found chunks into a context for the model."""
+        return format_chunks(chunks)
+    
+    def search_knowledge_base(self, query: str, top_k: int = SEARCH_TOP_K,
+                              max_chars: int = CONTEXT_MAX_CHARS, mode: str = RETRIEVER_MODE) -> Optional[str]:
+        """
+        Search the chunk index (BM25, vectors or both) and return the most
+        relevant chunks concatenated, within the given character budget.
+        """
+        return self.format_context(self.search_chunks(query, top_k, max_chars, mode))
@@ -1,39 +1,286 @@
 import os
-from typing import Optional
-from PyPDF2 import PdfReader
-from pdf2image import convert_from_path
-import pytesseract
-from PIL import Image
-import io
+import time
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, List, Optional, Tuple
+
+# PyPDF2, pdf2image, pytesseract и PIL импортируются в функциях процессов пула:
+# они нужны только при обработке файлов и не замедляют запуск бота
+from metrics import observe_stage, timed
+
+# Количество процессов для извлечения текста и OCR
+MAX_WORKERS = min(4, os.cpu_count() or 1)
+# Максимальное время одной задачи в секундах
+JOB_TIMEOUT = 120
+# Сколько задач может одновременно находиться в пуле; остальные ждут своей очереди
+MAX_PENDING_JOBS = MAX_WORKERS * 2
+# Сколько страниц PDF обрабатывает одна задача
+PDF_PAGES_PER_JOB = 8
+# Языки распознавания Tesseract
+OCR_LANG = "rus+eng"
+# Разрешение, с которым растрируются страницы PDF без текстового слоя
+OCR_DPI = 300
+# Изображения больше этого размера (по длинной стороне, в пикселях) уменьшаются перед OCR
+OCR_MAX_SIDE = 3600
+# Переводить изображение в черно-белое (порог по методу Оцу) перед распознаванием
+OCR_BINARIZE = True
+# Страница PDF, на которой меньше символов текста, считается сканом и распознается через OCR
+MIN_PAGE_TEXT_CHARS = 20
+
+# Параллельность дают процессы пула; собственные потоки Tesseract им только мешают
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+_pool: Optional[ProcessPoolExecutor] = None
+_job_slots: Optional[asyncio.Semaphore] = None
+
+
+def _count_pdf_pages(file_path: str) -> int:
+    from PyPDF2 import PdfReader
+    return len(PdfReader(file_path).pages)
+
+
+def _extract_pdf_pages(file_path: str, start: int, end: int) -> List[str]:
+    """Extract text of pages [start, end) in a worker process."""
+    from PyPDF2 import PdfReader
+    reader = PdfReader(file_path)
+    return [(reader.pages[i].extract_text() or "") for i in range(start, end)]
+
+
+def _otsu_threshold(histogram: List[int]) -> int:
+    """Gray level that best separates text from background."""
+    total = sum(histogram)
+    sum_all = sum(level * count for level, count in enumerate(histogram))
+    weight_background, sum_background = 0, 0
+    best_variance, threshold = 0.0, 127
+    for level, count in enumerate(histogram):
+        weight_background += count
+        if weight_background == 0:
+            continue
+        weight_foreground = total - weight_background
+        if weight_foreground == 0:
+            break
+        sum_background += level * count
+        mean_background = sum_background / weight_background
+        mean_foreground = (sum_all - sum_background) / weight_foreground
+        variance = weight_background * weight_foreground * (mean_background - mean_foreground) ** 2
+        if variance > best_variance:
+            best_variance, threshold = variance, level
+    return threshold
+
+
+def _prepare_image(image: "Image.Image") -> "Image.Image":
+    """Rotate by EXIF, convert to grayscale, downscale and binarize an image for OCR."""
+    from PIL import Image, ImageOps
+    image = ImageOps.exif_transpose(image).convert("L")
+    scale = OCR_MAX_SIDE / max(image.size)
+    if scale < 1:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.LANCZOS)
+    image = ImageOps.autocontrast(image)
+    if OCR_BINARIZE:
+        threshold = _otsu_threshold(image.histogram())
+        image = image.point([0 if level <= threshold else 255 for level in range(256)])
+    return image
+
+
+def _ocr(image: "Image.Image") -> str:
+    import pytesseract
+    return pytesseract.image_to_string(_prepare_image(image), lang=OCR_LANG)
+
+
+def _ocr_image(file_path: str) -> str:
+    """Run Tesseract on an image in a worker process."""
+    from PIL import Image
+    with Image.open(file_path) as image:
+        return _ocr(image)
+
+
+def _ocr_pdf_page(file_path: str, page_index: int) -> str:
+    """Rasterize a single PDF page and run Tesseract on it in a worker process."""
+    from pdf2image import convert_from_path
+    images = convert_from_path(file_path, dpi=OCR_DPI, first_page=page_index + 1,
+                               last_page=page_index + 1, grayscale=True)
+    return _ocr(images[0]) if images else ""
+
 
 class DocumentProcessor:
     @staticmethod
-    async def process_pdf(file_path: str) -> str:
-        """Extract text from PDF file."""
+    def configure(max_workers: Optional[int] = None, job_timeout: Optional[float] = None,
+                  max_pending_jobs: Optional[int] = None):
+        """Change worker pool settings; takes effect for the next created pool."""
+        global MAX_WORKERS, JOB_TIMEOUT, MAX_PENDING_JOBS, _job_slots
+        DocumentProcessor.shutdown()
+        if max_workers:
+            MAX_WORKERS = max_workers
+            MAX_PENDING_JOBS = max_workers * 2
+        if job_timeout:
+            JOB_TIMEOUT = job_timeout
+        if max_pending_jobs:
+            MAX_PENDING_JOBS = max_pending_jobs
+        _job_slots = None
+
+    @staticmethod
+    def shutdown():
+        """Stop worker processes and cancel queued jobs."""
+        global _pool
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+    @staticmethod
+    def _recycle_pool(pool: ProcessPoolExecutor):
+        """Kill the processes of a pool with a hung job; the next job starts a fresh pool."""
+        global _pool
+        if _pool is pool:
+            _pool = None
+        # Зависший процесс (Tesseract, PyPDF2) сам не завершится: останавливаем процессы пула,
+        # их задачи завершаются с BrokenProcessPool и освобождают слоты
+        for process in list((getattr(pool, "_processes", None) or {}).values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    async def run_in_pool(func, *args, timeout: Optional[float] = None):
+        """
+        Run a CPU-bound function in the process pool without blocking the event loop.
+        Jobs beyond MAX_PENDING_JOBS wait for a free slot, so bursts of uploads queue up.
+        """
+        global _pool, _job_slots
+        if _job_slots is None:
+            _job_slots = asyncio.Semaphore(MAX_PENDING_JOBS)
+        slots = _job_slots
+        waiting_since = time.perf_counter()
+        await slots.acquire()
+        observe_stage("queue_wait", time.perf_counter() - waiting_since)
+
+        loop = asyncio.get_running_loop()
+
+        def release_slot(_):
+            # Слот освобождается только когда процесс действительно закончил работу
+            try:
+                loop.call_soon_threadsafe(slots.release)
+            except RuntimeError:
+                pass
+
+        try:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=MAX_WORKERS)
+            pool = _pool
+            job = pool.submit(func, *args)
+        except Exception:
+            slots.release()
+            raise
+        job.add_done_callback(release_slot)
+
+        try:
+            # Отмена или таймаут снимают задачу из очереди пула, если она еще не начата
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout or JOB_TIMEOUT)
+        except asyncio.TimeoutError:
+            if not job.done():
+                # Задача уже выполняется и не может быть снята - иначе процесс и слот заняты навсегда
+                print(f"Job {getattr(func, '__name__', func)} exceeded timeout, restarting worker pool")
+                DocumentProcessor._recycle_pool(pool)
+            raise
+        except BrokenProcessPool:
+            if _pool is pool:
+                _pool = None
+            raise
+
+    @staticmethod
+    async def _extract_page_range(file_path: str, start: int, end: int,
+                                  failures: Optional[List[int]] = None) -> List[str]:
+        """
+        Text of pages [start, end); pages without a text layer are OCR'd in parallel.
+        Numbers of pages whose OCR failed are appended to failures.
+        """
+        pages = await DocumentProcessor.run_in_pool(_extract_pdf_pages, file_path, start, end)
+        scanned = [offset for offset, text in enumerate(pages) if len(text.strip()) < MIN_PAGE_TEXT_CHARS]
+        if not scanned:
+            return pages
+        results = await asyncio.gather(
+            *(DocumentProcessor.run_in_pool(_ocr_pdf_page, file_path, start + offset) for offset in scanned),
+            return_exceptions=True
+        )
+        for offset, result in zip(scanned, results):
+            if isinstance(result, Exception):
+                # Без OCR страница остается с тем текстом, что удалось извлечь
+                print(f"OCR failed for page {start + offset + 1} of {file_path}: {result!r}")
+                if failures is not None:
+                    failures.append(start + offset + 1)
+            else:
+                pages[offset] = result
+        return pages
+
+    @staticmethod
+    async def iter_pdf_pages(file_path: str, failures: Optional[List[int]] = None) -> AsyncIterator[str]:
+        """
+        Yield PDF page texts in page order as soon as they are ready.
+        All page ranges are processed in parallel in the worker pool;
+        pages whose OCR failed are reported in failures.
+        """
+        page_count = await DocumentProcessor.run_in_pool(_count_pdf_pages, file_path)
+        ranges = [
+            asyncio.ensure_future(DocumentProcessor._extract_page_range(
+                file_path, start, min(start + PDF_PAGES_PER_JOB, page_count), failures))
+            for start in range(0, page_count, PDF_PAGES_PER_JOB)
+        ]
         try:
-            reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
+            for page_range in ranges:
+                for page in await page_range:
+                    yield page
+        finally:
+            for page_range in ranges:
+                page_range.cancel()
+            # Дожидаемся отмененных задач, чтобы их исключения не остались необработанными
+            await asyncio.gather(*ranges, return_exceptions=True)
+
+    @staticmethod
+    async def process_pdf(file_path: str) -> str:
+        """Extract text from PDF file, processing page ranges in parallel."""
+        with timed("pdf"):
+            text, _ = await DocumentProcessor._process_pdf(file_path)
             return text
+
+    @staticmethod
+    async def _process_pdf(file_path: str) -> Tuple[str, bool]:
+        failures: List[int] = []
+        try:
+            pages = [page async for page in DocumentProcessor.iter_pdf_pages(file_path, failures)]
+            return "".join(page + "\n" for page in pages), not failures
+        except asyncio.TimeoutError:
+            return "Error processing PDF: timeout", False
         except Exception as e:
-            return f"Error processing PDF: {str(e)}"
+            return f"Error processing PDF: {str(e)}", False
 
     @staticmethod
     async def process_image(file_path: str) -> str:
         """Extract text from image using OCR."""
         try:
-            image = Image.open(file_path)
-            text = pytesseract.image_to_string(image)
-            return text
+            with timed("ocr"):
+                return await DocumentProcessor.run_in_pool(_ocr_image, file_path)
+        except asyncio.TimeoutError:
+            return "Error processing image: timeout"
         except Exception as e:
             return f"Error processing image: {str(e)}"
 
+    @staticmethod
+    async def extract(file_path: str, file_type: str) -> Tuple[Optional[str], bool]:
+        """
+        Text of a PDF or image and whether it is complete. Text with errors or
+        pages whose OCR failed is incomplete and must not be cached, so that
+        extraction is retried next time.
+        """
+        if file_type == "pdf":
+            with timed("pdf"):
+                return await DocumentProcessor._process_pdf(file_path)
+        elif file_type in ("jpg", "jpeg", "png", "image"):
+            text = await DocumentProcessor.process_image(file_path)
+            return text, not text.startswith("Error processing")
+        return None, False
+
     @staticmethod
     async def process_document(file_path: str, file_type: str) -> Optional[str]:
         """Process document based on its type."""
-        if file_type == "pdf":
-            return await DocumentProcessor.process_pdf(file_path)
-        elif file_type in ["jpg", "jpeg", "png"]:
-            return await DocumentProcessor.process_image(file_path)
-        return None 
\ No newline at end of file
+        text, _ = await DocumentProcessor.extract(file_path, file_type)
+        return text
@@ -0,0 +1,106 @@
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Optional
+
+# Файл кэша извлеченного текста (общий для бота и train_bot.py)
+EXTRACTION_CACHE_FILE = "extraction_cache.db"
+# Максимальный размер кэша (байт, после сжатия); давно не использованные записи удаляются первыми
+EXTRACTION_CACHE_MAX_BYTES = 200 * 1024 * 1024
+# Увеличить при изменении извлечения текста, чтобы старые результаты не использовались
+EXTRACTION_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS extractions (
+    key TEXT PRIMARY KEY,
+    text BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS extractions_used ON extractions(used);
+CREATE TABLE IF NOT EXISTS telegram_files (
+    file_unique_id TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (file_unique_id, kind)
+);
+"""
+
+
+class ExtractionCache:
+    """
+    Content-addressed cache of text extracted from PDFs and images. Entries
+    are keyed by the SHA-256 of the file bytes; Telegram file_unique_id is
+    mapped to the same entry, so a file users forward again is not even
+    downloaded. Texts are stored compressed and evicted least recently used
+    once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, db_file: str = EXTRACTION_CACHE_FILE, max_bytes: int = EXTRACTION_CACHE_MAX_BYTES):
+        self.db_file = db_file
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _key(sha256: str, kind: str) -> str:
+        return f"{kind}:{EXTRACTION_VERSION}:{sha256}"
+
+    def _read(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute("SELECT text FROM extractions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE extractions SET used = ? WHERE key = ?", (time.time(), key))
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def get(self, sha256: str, kind: str) -> Optional[str]:
+        return self._read(self._key(sha256, kind))
+
+    def get_by_file_id(self, file_unique_id: str, kind: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT key FROM telegram_files WHERE file_unique_id = ? AND kind = ?", (file_unique_id, kind)
+            ).fetchone()
+        return self._read(row[0]) if row else None
+
+    def put(self, sha256: str, kind: str, text: str):
+        content = zlib.compress(text.encode('utf-8'))
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO extractions (key, text, size, used) VALUES (?, ?, ?, ?)",
+                    (self._key(sha256, kind), content, len(content), time.time())
+                )
+                self._evict()
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def remember_file_id(self, file_unique_id: str, sha256: str, kind: str):
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO telegram_files (file_unique_id, kind, key) VALUES (?, ?, ?)",
+                (file_unique_id, kind, self._key(sha256, kind))
+            )
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM extractions").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute("SELECT key, size FROM extractions ORDER BY used").fetchall():
+            self.conn.execute("DELETE FROM extractions WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+        self.conn.execute("DELETE FROM telegram_files WHERE key NOT IN (SELECT key FROM extractions)")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
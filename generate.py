@@ -1,26 +1,57 @@
-from openai import AsyncOpenAI, OpenAI
+import time
+from typing import Dict, List, Optional
 from config import AI_TOKEN
 from system_prompt import get_system_prompt
+from answer_cache import AnswerCache
+from context_builder import build_context, context_budget, count_tokens
+from llm_client import LLMClient
+from metrics import CACHE_REQUESTS, PROMPT_TOKENS, observe_stage, timed
 
-# Создаем клиента с минимальными параметрами, чтобы избежать ошибки
-# client = AsyncOpenAI(
-#     api_key=AI_TOKEN,
-#     base_url="https://openrouter.ai/api/v1"
-# )
+BASE_URL = "https://openrouter.ai/api/v1"
+MODEL = "meta-llama/llama-3.3-8b-instruct:free"
+# Модели, к которым переходим, если основная недоступна
+FALLBACK_MODELS = ["mistralai/mistral-7b-instruct:free"]
+MAX_TOKENS = 2000
+# Длина сводки разговора (токенов)
+SUMMARY_MAX_TOKENS = 300
+# Не больше MAX_IN_FLIGHT одновременных запросов и RATE_PER_SECOND запросов в секунду
+MAX_IN_FLIGHT = 4
+RATE_PER_SECOND = 2.0
 
-client = AsyncOpenAI(
+client = LLMClient(
     api_key=AI_TOKEN,
-    base_url="https://openrouter.ai/api/v1"
+    base_url=BASE_URL,
+    models=[MODEL] + FALLBACK_MODELS,
+    max_in_flight=MAX_IN_FLIGHT,
+    rate_per_second=RATE_PER_SECOND
 )
 
-async def ai_generate(text: str, context: str = None, system_prompt_type: str = "default"):
+FALLBACK_ANSWER = "Извините, в данный момент я не могу сгенерировать ответ. Попробуйте позже."
+
+# Кэш ответов на повторяющиеся вопросы
+answer_cache = AnswerCache()
+
+def build_messages(text: str, context=None, system_prompt_type: str = "default", model: str = MODEL,
+                   history: Optional[List[Dict]] = None):
+    """
+    Собирает сообщения для модели. Контекст (строка или список фрагментов с оценками)
+    урезается так, чтобы промпт вместе с ответом поместился в окно модели.
+    История разговора (уже уложенная в свой бюджет) идет между системным промптом и вопросом.
+    """
     messages = []
+    system_prompt = get_system_prompt(system_prompt_type)
     
     # Добавляем системный промпт
     messages.append({
         "role": "system",
-        "content": get_system_prompt(system_prompt_type)
+        "content": system_prompt
     })
+    history = history or []
+    messages.extend(history)
+    
+    fixed_text = system_prompt + "".join(message["content"] for message in history) + text
+    budget = context_budget(model, MAX_TOKENS, fixed_text + "Контекст: \n\nВопрос: ")
+    context, report = build_context(context, budget)
     
     if context:
         messages.append({
@@ -33,24 +64,109 @@ async def ai_generate(text: str, context: str = None, system_prompt_type: str =
             "content": text
         })
     
+    prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+    PROMPT_TOKENS.observe(prompt_tokens)
+    print(f"Размер промпта: ~{prompt_tokens} токенов (контекст {report['context_tokens']}/{report['budget']}, "
+          f"фрагментов {report['chunks_used']}, отброшено {report['chunks_dropped']})")
+    return messages
+
+async def ai_generate(text: str, context=None, system_prompt_type: str = "default",
+                      history: Optional[List[Dict]] = None):
+    messages = build_messages(text, context, system_prompt_type, history=history)
+    
     try:
-        completion = await client.chat.completions.create(
-            model="meta-llama/llama-3.3-8b-instruct:free",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=2000
-        )
-        
-        return completion.choices[0].message.content
+        with timed("llm"):
+            return await client.complete(
+                messages,
+                temperature=0.7,
+                max_tokens=MAX_TOKENS
+            )
     except Exception as e:
         print(f"Ошибка при вызове OpenAI API: {str(e)}")
         # Запасной вариант для ответа, если API недоступен
-        return "Извините, в данный момент я не могу сгенерировать ответ. Попробуйте позже."
+        return FALLBACK_ANSWER
+
+def cached_answer(prompt: str, chunk_ids: Optional[List[int]], system_prompt_type: str = "default") -> Optional[str]:
+    """Готовый ответ из кэша по вопросу и id найденных фрагментов или None."""
+    if chunk_ids is None:
+        return None
+    cached = answer_cache.get(prompt, chunk_ids, system_prompt_type)
+    CACHE_REQUESTS.inc(result="miss" if cached is None else "hit")
+    return cached
+
+async def ask_gpt(prompt: str, context=None, system_prompt_type: str = "default",
+                  chunk_ids: Optional[List[int]] = None, history: Optional[List[Dict]] = None,
+                  check_cache: bool = True):
+    """
+    Отправляет запрос в ChatGPT с возможностью добавления контекста и системного промпта.
+    Если переданы id найденных фрагментов базы знаний, ответ берется из кэша или сохраняется в него.
+    """
+    # check_cache=False - вызывающий код уже искал ответ в кэше, повторный промах не учитываем
+    cached = cached_answer(prompt, chunk_ids, system_prompt_type) if check_cache else None
+    if cached is not None:
+        return cached
+    try:
+        response = await ai_generate(prompt, context, system_prompt_type, history)
+        response = response.strip()
+    except Exception as e:
+        return f"Произошла ошибка при генерации ответа: {str(e)}"
+    if chunk_ids is not None and response != FALLBACK_ANSWER:
+        answer_cache.put(prompt, chunk_ids, system_prompt_type, response)
+    return response
+
+async def ai_generate_stream(text: str, context=None, system_prompt_type: str = "default",
+                             history: Optional[List[Dict]] = None):
+    """Генерирует ответ потоково, отдавая фрагменты текста по мере их получения. Ошибки API пробрасываются."""
+    messages = build_messages(text, context, system_prompt_type, history=history)
+    async for delta in client.stream(
+        messages,
+        temperature=0.7,
+        max_tokens=MAX_TOKENS
+    ):
+        yield delta
+
+async def ask_gpt_stream(prompt: str, context=None, system_prompt_type: str = "default",
+                         chunk_ids: Optional[List[int]] = None, history: Optional[List[Dict]] = None,
+                         check_cache: bool = True):
+    """Потоковый вариант ask_gpt: ответ из кэша отдается целиком, иначе - по мере генерации."""
+    cached = cached_answer(prompt, chunk_ids, system_prompt_type) if check_cache else None
+    if cached is not None:
+        yield cached
+        return
+    
+    parts = []
+    started = time.perf_counter()
+    try:
+        async for delta in ai_generate_stream(prompt, context, system_prompt_type, history):
+            if not parts:
+                # Время до первого токена - задержка, которую видит пользователь
+                observe_stage("llm_ttft", time.perf_counter() - started)
+            parts.append(delta)
+            yield delta
+    except Exception as e:
+        print(f"Ошибка при вызове OpenAI API: {str(e)}")
+        if not parts:
+            yield FALLBACK_ANSWER
+        return
+    observe_stage("llm", time.perf_counter() - started)
+    
+    # Кэшируем только полностью полученные ответы
+    if chunk_ids is not None and parts:
+        answer_cache.put(prompt, chunk_ids, system_prompt_type, "".join(parts).strip())
+
 
-async def ask_gpt(prompt: str, context: str = None, system_prompt_type: str = "default"):
-    """Отправляет запрос в ChatGPT с возможностью добавления контекста и системного промпта."""
+async def summarize_conversation(summary: str, turns: List[Dict]) -> Optional[str]:
+    """Сворачивает предыдущую сводку и старые реплики разговора в новую сводку; None при ошибке API."""
+    dialog = "\n".join(f"Пользователь: {turn['question']}\nАссистент: {turn['answer']}" for turn in turns)
+    content = f"Предыдущая сводка: {summary}\n\n{dialog}" if summary else dialog
+    messages = [
+        {"role": "system", "content": get_system_prompt("summary")},
+        {"role": "user", "content": content}
+    ]
     try:
-        response = await ai_generate(prompt, context, system_prompt_type)
-        return response.strip()
+        with timed("summary"):
+            response = await client.complete(messages, temperature=0.2, max_tokens=SUMMARY_MAX_TOKENS)
     except Exception as e:
-        return f"Произошла ошибка при генерации ответа: {str(e)}"
\ No newline at end of file
+        print(f"Ошибка при сворачивании истории разговора: {str(e)}")
+        return None
+    return response.strip() or None
@@ -4,31 +4,155 @@ from aiogram.filters import CommandStart, Command
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 import os
+import asyncio
 import tempfile
-import aiohttp
-from bs4 import BeautifulSoup
 import re
 import json
 from datetime import datetime
 
-from generate import ask_gpt
+from generate import ask_gpt, ask_gpt_stream, answer_cache, cached_answer, summarize_conversation, FALLBACK_ANSWER
+from streaming import stream_answer, send_markdown, QueueNotice
+from context_builder import count_tokens
+from scheduler import GenerationScheduler, QueueDropped, PRIORITY_NORMAL, priority_for
 from document_processor import DocumentProcessor
 from data_loader import DataLoader
+from session_store import ContextStore, ConversationStore, STATE_DB_FILE
+from conversation import ConversationMemory, is_follow_up, rewrite_query, merge_results
+from extraction_cache import ExtractionCache, EXTRACTION_CACHE_FILE
+from upload_index import UploadIndex, UploadIndexCache, KNOWLEDGE_TOP_K
 
 router = Router()
 
 # Создаем экземпляр DataLoader только один раз при старте
 data_loader = None
 
-# Указываем сайт для поиска
-SEARCH_SITE = "ru.siberianhealth.com/ru/"
+# Отправлять ответ по мере генерации, редактируя сообщение
+STREAM_RESPONSES = True
+
+# Хранилища открываются в init_stores при запуске бота, а не при импорте модуля
+# Тексты загруженных документов хранятся вне состояния диалога, в состоянии - только их id
+context_store = None
+# Текст уже обработанных файлов: повторно присланный файл не скачивается и не распознается заново
+extraction_cache = None
+# Типы файлов, из которых извлекается текст, и их вид в кэше
+UPLOAD_KINDS = {"pdf": "pdf", "jpg": "image", "jpeg": "image", "png": "image"}
+# Поисковые индексы по загруженным документам, чтобы не строить их на каждый вопрос
+upload_indexes = UploadIndexCache()
+# Очередь запросов к модели: общий лимит одновременных генераций, честная очередь по пользователям
+generation_scheduler = GenerationScheduler()
+# История разговоров: уточняющие вопросы понимаются с учетом предыдущих, старые реплики сворачиваются в сводку
+conversation_memory = ConversationMemory(None, summarize_conversation, generation_scheduler)
+QUEUE_TIMEOUT_TEXT = "Сейчас слишком много запросов, и ответ не успел начаться. Пожалуйста, задайте вопрос еще раз чуть позже."
 
 # Инициализация data_loader отложена до запуска бота
 async def init_data_loader():
+    loader = DataLoader()
+    await loader.process_directory()
+    set_data_loader(loader)
+    return loader
+
+def init_stores(state_db: str = STATE_DB_FILE, extraction_db: str = EXTRACTION_CACHE_FILE):
+    """Открывает хранилища документов, истории разговоров и кэш извлеченного текста."""
+    global context_store, extraction_cache
+    context_store = ContextStore(state_db)
+    extraction_cache = ExtractionCache(extraction_db)
+    conversation_memory.store = ConversationStore(state_db)
+
+def set_data_loader(loader: DataLoader):
+    """Подменяет базу знаний для всех следующих запросов одним присваиванием."""
     global data_loader
-    data_loader = DataLoader()
-    await data_loader.process_directory()
-    return data_loader
+    data_loader = loader
+    # Ответы, сгенерированные по старой базе знаний, больше не актуальны
+    answer_cache.set_version(loader.version)
+
+async def extract_upload(message: Message, file, file_type: str):
+    """Извлекает текст присланного файла, используя кэш по file_unique_id и хешу содержимого."""
+    kind = UPLOAD_KINDS.get(file_type)
+    if kind is None:
+        return None
+    text = await asyncio.to_thread(extraction_cache.get_by_file_id, file.file_unique_id, kind)
+    if text is not None:
+        return text
+    
+    # Create temporary file
+    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{file_type}") as temp_file:
+        pass
+    try:
+        # Ошибка скачивания (например, слишком большой файл) тоже не должна оставлять временный файл
+        await message.bot.download(file, destination=temp_file.name)
+        file_hash = await asyncio.to_thread(DataLoader._file_hash, temp_file.name)
+        text = await asyncio.to_thread(extraction_cache.get, file_hash, kind)
+        if text is None:
+            text, complete = await DocumentProcessor.extract(temp_file.name, file_type)
+            if not text or text.startswith("Error processing"):
+                # Текст ошибки не должен стать контекстом документа: обработчик сообщит о неудаче
+                return None
+            if not complete:
+                # Часть страниц не распознана: отвечаем по тому, что есть, но не кэшируем
+                return text
+            await asyncio.to_thread(extraction_cache.put, file_hash, kind, text)
+        await asyncio.to_thread(extraction_cache.remember_file_id, file.file_unique_id, file_hash, kind)
+        return text
+    finally:
+        # Clean up
+        os.unlink(temp_file.name)
+
+async def save_context(state: FSMContext, text: str, name: str):
+    """Сохраняет текст документа пользователя, индексирует его и запоминает ссылку в состоянии."""
+    data = await state.get_data()
+    await asyncio.to_thread(context_store.delete, data.get('context_id'))
+    upload_indexes.discard(data.get('context_id'))
+    context_id = await asyncio.to_thread(context_store.put, text)
+    upload_indexes.put(context_id, await asyncio.to_thread(UploadIndex, text, name))
+    await state.update_data(context_id=context_id, context_name=name)
+
+async def get_upload_index(state: FSMContext):
+    """Индекс загруженного документа; после перезапуска или в другом процессе строится заново по тексту."""
+    data = await state.get_data()
+    context_id = data.get('context_id')
+    index = upload_indexes.get(context_id)
+    if index is None:
+        text = await asyncio.to_thread(context_store.get, context_id)
+        if text is None:
+            return None
+        index = await asyncio.to_thread(UploadIndex, text, data.get('context_name', 'документ'))
+        upload_indexes.put(context_id, index)
+    return index
+
+async def clear_state(state: FSMContext):
+    """Сбрасывает состояние диалога вместе с сохраненным текстом документа."""
+    data = await state.get_data()
+    await asyncio.to_thread(context_store.delete, data.get('context_id'))
+    upload_indexes.discard(data.get('context_id'))
+    await state.clear()
+
+async def generate_reply(message: Message, prompt: str, context=None, system_prompt_type: str = "default",
+                         chunk_ids=None, priority: int = PRIORITY_NORMAL, history=None) -> str:
+    """
+    Отвечает на вопрос и возвращает текст ответа: ответ из кэша отправляется сразу,
+    остальные запросы ждут своей очереди к модели, а пользователь видит свое место в ней.
+    Если запрос отброшен (истек срок ожидания или /reset), выбрасывает QueueDropped.
+    """
+    cached = cached_answer(prompt, chunk_ids, system_prompt_type)
+    if cached is not None:
+        await send_markdown(message, cached)
+        return cached
+    
+    user_id = message.from_user.id if message.from_user else message.chat.id
+    notice = QueueNotice(message)
+    try:
+        async with generation_scheduler.slot(user_id, priority, notice.update):
+            await notice.remove()
+            # Кэш уже проверен выше; chunk_ids нужны, чтобы сохранить в него новый ответ
+            if STREAM_RESPONSES:
+                return await stream_answer(
+                    message, ask_gpt_stream(prompt, context, system_prompt_type, chunk_ids, history, check_cache=False)
+                )
+            response = await ask_gpt(prompt, context, system_prompt_type, chunk_ids, history, check_cache=False)
+            await send_markdown(message, response)
+            return response
+    finally:
+        await notice.remove()
 
 class Gen(StatesGroup):
     wait = State()
@@ -41,6 +165,14 @@ class AddInfo(StatesGroup):
 async def cmd_start(message: Message):
     await message.answer('Добро пожаловать! Я тут для того, чтобы помочь разобраться в компании Siberian Wellenss, ответить на вопросы о здоровье и рассказать о том как построить бизнес. Можешь задавать свои вопросы! Будем разбираться!')
 
+@router.message(Command("reset"))
+async def cmd_reset(message: Message, state: FSMContext):
+    # Пользователь передумал ждать: убираем его запросы из очереди к модели
+    generation_scheduler.cancel(message.from_user.id if message.from_user else message.chat.id)
+    await clear_state(state)
+    await conversation_memory.clear(str(message.chat.id))
+    await message.answer("Документ и история разговора забыты. Можете задавать обычные вопросы.")
+
 @router.message(Gen.wait)
 async def stop_flood(message: Message):
     await message.answer('Подождите, ваш запрос генерируется.')
@@ -49,62 +181,74 @@ async def stop_flood(message: Message):
 async def handle_document(message: Message, state: FSMContext):
     await state.set_state(Gen.wait)
     doc = message.document
-    
-    # Create temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=f".{doc.file_name.split('.')[-1]}") as temp_file:
-        await message.bot.download(doc, destination=temp_file.name)
-        
+    try:
         # Process document
         file_type = doc.file_name.split('.')[-1].lower()
-        extracted_text = await DocumentProcessor.process_document(temp_file.name, file_type)
-        
-        # Clean up
-        os.unlink(temp_file.name)
+        extracted_text = await extract_upload(message, doc, file_type)
         
         if extracted_text:
-            # Store context in state
-            await state.update_data(context=extracted_text)
-            await message.answer("Документ обработан. Теперь вы можете задать вопрос по его содержимому.")
+            # Store context out of the FSM state
+            await save_context(state, extracted_text, doc.file_name)
+            await message.answer("Документ обработан. Теперь вы можете задавать вопросы по его содержимому. "
+                                 "Чтобы закончить, отправьте /reset.")
             await state.set_state(Gen.context)
         else:
             await message.answer("Не удалось обработать документ. Пожалуйста, попробуйте другой файл.")
-            await state.clear()
+            await clear_state(state)
+    except Exception as e:
+        # Иначе чат останется в Gen.wait, а состояние хранится в базе и переживает перезапуск
+        await message.answer(f'Произошла ошибка: {str(e)}')
+        await clear_state(state)
 
 @router.message(F.photo)
 async def handle_photo(message: Message, state: FSMContext):
     await state.set_state(Gen.wait)
     photo = message.photo[-1]  # Get the largest photo
-    
-    # Create temporary file
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as temp_file:
-        await message.bot.download(photo, destination=temp_file.name)
-        
+    try:
         # Process image
-        extracted_text = await DocumentProcessor.process_image(temp_file.name)
-        
-        # Clean up
-        os.unlink(temp_file.name)
+        extracted_text = await extract_upload(message, photo, "jpg")
         
         if extracted_text:
-            # Store context in state
-            await state.update_data(context=extracted_text)
-            await message.answer("Изображение обработано. Теперь вы можете задать вопрос по его содержимому.")
+            # Store context out of the FSM state
+            await save_context(state, extracted_text, "изображение")
+            await message.answer("Изображение обработано. Теперь вы можете задавать вопросы по его содержимому. "
+                                 "Чтобы закончить, отправьте /reset.")
             await state.set_state(Gen.context)
         else:
             await message.answer("Не удалось обработать изображение. Пожалуйста, попробуйте другое изображение.")
-            await state.clear()
+            await clear_state(state)
+    except Exception as e:
+        await message.answer(f'Произошла ошибка: {str(e)}')
+        await clear_state(state)
 
-@router.message(Gen.context)
+@router.message(Gen.context, F.text)
 async def handle_context_question(message: Message, state: FSMContext):
     await state.set_state(Gen.wait)
-    data = await state.get_data()
-    context = data.get('context', '')
-    
-    # Combine context with question
-    prompt = f"Контекст: {context}\n\nВопрос: {message.text}"
-    response = await ask_gpt(prompt)
-    await message.answer(response, parse_mode="Markdown")
-    await state.clear()
+    try:
+        upload = await get_upload_index(state)
+        if upload is None:
+            await message.answer("Срок хранения документа истек. Пожалуйста, отправьте его еще раз.")
+            await clear_state(state)
+            return
+        
+        # В модель передаются только фрагменты документа, относящиеся к вопросу
+        context = upload.search(message.text)
+        if KNOWLEDGE_TOP_K and data_loader is not None:
+            # Фрагменты базы знаний идут после фрагментов документа
+            context += [dict(chunk, score=0.0)
+                        for chunk in data_loader.search_chunks(message.text, top_k=KNOWLEDGE_TOP_K)]
+        
+        # Вопросы по документам с большим контекстом идут после коротких вопросов по базе знаний
+        await generate_reply(message, message.text, context, priority=priority_for(0, document=True))
+    except QueueDropped as e:
+        if e.reason == "timeout":
+            await message.answer(QUEUE_TIMEOUT_TEXT)
+    except Exception as e:
+        await message.answer(f'Произошла ошибка: {str(e)}')
+    finally:
+        # Документ остается доступным для следующих вопросов, если пользователь не сбросил его через /reset
+        if await state.get_state() == Gen.wait.state:
+            await state.set_state(Gen.context)
 
 @router.message(Command("addinfo"))
 async def cmd_addinfo(message: Message, state: FSMContext):
@@ -152,16 +296,31 @@ async def handle_message(message: Message, state: FSMContext):
     await state.set_state(Gen.wait)
     
     try:
-        # Ищем релевантную информацию в базе знаний
-        relevant_context = data_loader.search_knowledge_base(message.text)
+        # Уточняющий вопрос ищем вместе с предыдущим, чтобы найти, о чем идет речь,
+        # и только ему передаем историю разговора
+        chat = str(message.chat.id)
+        summary, turns = await conversation_memory.load(chat)
+        history = conversation_memory.messages(summary, turns) if is_follow_up(message.text, turns) else []
         
-        if relevant_context:
-            # Если найдена релевантная информация, используем ее
-            response = await ask_gpt(message.text, relevant_context, "siberian_health")
-        else:
-            response = await ask_gpt(message.text, system_prompt_type="siberian_health")
+        # Ищем релевантную информацию в базе знаний
+        # Фрагменты передаются с оценками: в промпт попадут лучшие, сколько влезет в окно модели
+        chunks = merge_results([data_loader.search_chunks(query) for query in rewrite_query(message.text, turns)])
+        relevant_context = chunks or None
+        # По id найденных фрагментов ищем готовый ответ в кэше. Ответ, сгенерированный с историей
+        # разговора, зависит от нее и может содержать личные сведения, поэтому в общий кэш он не попадает
+        chunk_ids = [chunk["id"] for chunk in chunks] if not history else None
+        # Короткие вопросы с небольшим контекстом обслуживаются в очереди первыми
+        prompt_tokens = (count_tokens(message.text) + sum(count_tokens(chunk["text"]) for chunk in chunks)
+                         + sum(count_tokens(item["content"]) for item in history))
         
-        await message.answer(response, parse_mode="Markdown")
+        # Если найдена релевантная информация, используем ее как контекст
+        answer = await generate_reply(message, message.text, relevant_context, "siberian_health", chunk_ids,
+                                      priority_for(prompt_tokens), history)
+        if answer and answer != FALLBACK_ANSWER:
+            await conversation_memory.remember(chat, message.text, answer)
+    except QueueDropped as e:
+        if e.reason == "timeout":
+            await message.answer(QUEUE_TIMEOUT_TEXT)
     except Exception as e:
         await message.answer(f'Произошла ошибка: {str(e)}', parse_mode="Markdown")
     finally:
@@ -0,0 +1,115 @@
+import os
+import asyncio
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+from data_loader import DataLoader, SOURCE_DIRS
+
+logger = logging.getLogger(__name__)
+
+# Как часто проверять директорию с обучающими данными (сек)
+RELOAD_INTERVAL = 10.0
+
+
+class KnowledgeWatcher:
+    """
+    Background task that polls the training data directory and, when files
+    change, incrementally ingests them into a fresh DataLoader built off to
+    the side. The new loader is handed to `on_reload`, which swaps it into the
+    handlers in one assignment; searches already running keep the old one.
+    """
+
+    def __init__(self, data_dir: str, on_reload: Callable[[DataLoader], None],
+                 interval: float = RELOAD_INTERVAL, catch_up: bool = False):
+        self.data_dir = data_dir
+        self.on_reload = on_reload
+        self.interval = interval
+        # Сначала догнать изменения, сделанные пока бот не работал (бот стартует со старого снимка индекса)
+        self.catch_up = catch_up
+        self.loaded_snapshot: Optional[Dict[str, Tuple[int, float]]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def snapshot(self) -> Dict[str, Tuple[int, float]]:
+        """Size and mtime of every supported training file."""
+        files = {}
+        for subdir, _, extensions in SOURCE_DIRS:
+            dir_path = os.path.join(self.data_dir, subdir)
+            if not os.path.isdir(dir_path):
+                continue
+            for entry in os.scandir(dir_path):
+                if entry.is_file() and entry.name.lower().endswith(extensions):
+                    stat = entry.stat()
+                    files[f"{subdir}/{entry.name}"] = (stat.st_size, stat.st_mtime)
+        return files
+
+    async def reload(self) -> DataLoader:
+        loader = await asyncio.to_thread(DataLoader, self.data_dir)
+        await loader.process_directory()
+        self.on_reload(loader)
+        return loader
+
+    async def run(self):
+        self.loaded_snapshot = await asyncio.to_thread(self.snapshot)
+        previous = self.loaded_snapshot
+        if self.catch_up:
+            try:
+                loader = await asyncio.to_thread(DataLoader, self.data_dir)
+                await loader.process_directory()
+                if loader.last_report:
+                    self.on_reload(loader)
+                    logger.info("База знаний обновлена по изменениям, сделанным до запуска")
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении базы знаний: {e}")
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                current = await asyncio.to_thread(self.snapshot)
+                # Ждем, пока файлы перестанут меняться (например, еще копируются)
+                if current != self.loaded_snapshot and current == previous:
+                    logger.info("Обнаружены изменения в обучающих данных, обновляю базу знаний")
+                    await self.reload()
+                    self.loaded_snapshot = current
+                    logger.info("База знаний обновлена")
+                previous = current
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении базы знаний: {e}")
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class SnapshotWatcher(KnowledgeWatcher):
+    """
+    Watcher for processes that only read the knowledge base (webhook workers).
+    Files are ingested by another process; here the saved index snapshot is
+    reloaded once the index and embedding files have stopped changing.
+    """
+
+    # Файлы индекса, которые DataLoader сохраняет в директории данных
+    SNAPSHOT_FILES = ("search_index.bin", "embeddings.npy", "embeddings.json")
+
+    def snapshot(self) -> Dict[str, Tuple[int, float]]:
+        files = {}
+        for name in self.SNAPSHOT_FILES:
+            path = os.path.join(self.data_dir, name)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                files[name] = (stat.st_size, stat.st_mtime)
+        return files
+
+    async def reload(self) -> DataLoader:
+        loader = await asyncio.to_thread(DataLoader, self.data_dir)
+        self.on_reload(loader)
+        return loader
@@ -0,0 +1,158 @@
+import os
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    name TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    path TEXT,
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT,
+    chars INTEGER NOT NULL DEFAULT 0,
+    chunk_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS contents (
+    name TEXT PRIMARY KEY REFERENCES documents(name) ON DELETE CASCADE,
+    content TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    document TEXT NOT NULL REFERENCES documents(name) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS chunks_document ON chunks(document);
+"""
+
+DOCUMENT_COLUMNS = ("name", "type", "path", "size", "mtime", "sha256", "chars", "chunk_count")
+
+
+class KnowledgeStore:
+    """
+    SQLite storage for the knowledge base: document metadata, full contents
+    and chunks live in separate tables, so metadata can be listed and single
+    chunks fetched by id without reading whole documents. Every upsert is one
+    transaction in WAL mode, so a crash never leaves a half-written base.
+    """
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA foreign_keys=ON")
+        self.conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM documents LIMIT 1").fetchone() is None
+
+    def list_documents(self) -> Dict[str, Dict]:
+        """Return metadata of all documents (without their content)."""
+        with self._lock:
+            rows = self.conn.execute(f"SELECT {', '.join(DOCUMENT_COLUMNS)} FROM documents ORDER BY name").fetchall()
+        return {row[0]: dict(zip(DOCUMENT_COLUMNS, row)) for row in rows}
+
+    def get_content(self, name: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute("SELECT content FROM contents WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def iter_contents(self) -> Iterator[Tuple[str, str]]:
+        with self._lock:
+            rows = self.conn.execute("SELECT name, content FROM contents ORDER BY name").fetchall()
+        yield from rows
+
+    def get_chunks(self, chunk_ids: List[int]) -> Dict[int, Dict]:
+        """Fetch chunks by id."""
+        if not chunk_ids:
+            return {}
+        placeholders = ",".join("?" * len(chunk_ids))
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT id, document, text FROM chunks WHERE id IN ({placeholders})", list(chunk_ids)
+            ).fetchall()
+        return {row[0]: {"id": row[0], "source": row[1], "text": row[2]} for row in rows}
+
+    def iter_chunks(self) -> Iterator[Tuple[int, str, str]]:
+        """Yield (chunk_id, document, text) for all chunks in a stable order."""
+        with self._lock:
+            rows = self.conn.execute("SELECT id, document, text FROM chunks ORDER BY id").fetchall()
+        yield from rows
+
+    def upsert_document(self, name: str, doc_type: str, content: str, chunks: List[str],
+                        file_meta: Optional[Dict] = None):
+        """Atomically replace a document together with its chunks."""
+        with self.transaction() as conn:
+            self._write_document(conn, name, doc_type, content, chunks, file_meta or {})
+
+    @staticmethod
+    def _write_document(conn: sqlite3.Connection, name: str, doc_type: str, content: str,
+                        chunks: List[str], file_meta: Dict):
+        conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+        conn.execute(
+            "INSERT INTO documents (name, type, path, size, mtime, sha256, chars, chunk_count) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, doc_type, file_meta.get("path"), file_meta.get("size"), file_meta.get("mtime"),
+             file_meta.get("sha256"), len(content), len(chunks))
+        )
+        conn.execute("INSERT INTO contents (name, content) VALUES (?, ?)", (name, content))
+        conn.executemany(
+            "INSERT INTO chunks (document, position, text) VALUES (?, ?, ?)",
+            [(name, position, text) for position, text in enumerate(chunks)]
+        )
+
+    def update_file_meta(self, name: str, file_meta: Dict):
+        """Record source file path, size, mtime and hash of an existing document."""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE documents SET path = ?, size = ?, mtime = ?, sha256 = ? WHERE name = ?",
+                (file_meta.get("path"), file_meta.get("size"), file_meta.get("mtime"),
+                 file_meta.get("sha256"), name)
+            )
+
+    def delete_document(self, name: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM documents WHERE name = ?", (name,))
+
+    def clear(self):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM documents")
+
+    def migrate_from_json(self, kb_file: str, chunker, manifest_file: Optional[str] = None) -> int:
+        """One-shot import of the legacy knowledge_base.json (and manifest.json)."""
+        with open(kb_file, 'r', encoding='utf-8') as f:
+            knowledge_base = json.load(f)
+        manifest = {}
+        if manifest_file and os.path.exists(manifest_file):
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                for path, entry in json.load(f).items():
+                    manifest[entry["filename"]] = dict(entry, path=path)
+
+        with self.transaction() as conn:
+            for name, data in knowledge_base.items():
+                content = data.get("content", "")
+                self._write_document(conn, name, data.get("type", "text"), content,
+                                     chunker(content), manifest.get(name, {}))
+        return len(knowledge_base)
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import json
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+from metrics import LLM_ERRORS
+
+# Коды ответа, при которых запрос имеет смысл повторить
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """Token bucket rate limiter: `rate` requests per second with bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Read the Retry-After header (seconds or HTTP date) from an API error."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    from openai import APIConnectionError, APIStatusError, APITimeoutError
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS
+
+
+class LLMClient:
+    """
+    Wrapper around an OpenAI-compatible API with a cap on requests in flight,
+    a token-bucket rate limit, exponential backoff with jitter on 429/5xx
+    (honoring Retry-After), single-flight coalescing of identical concurrent
+    requests and a chain of fallback models.
+    """
+
+    def __init__(self, api_key: str, base_url: str, models: List[str],
+                 max_in_flight: int = 4, rate_per_second: float = 2.0, burst: Optional[float] = None,
+                 max_retries: int = 3, base_delay: float = 1.0, max_delay: float = 30.0,
+                 timeout: float = 60.0):
+        self.models = models
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout = timeout
+        self._client = None
+        self.burst = burst
+        self.configure(max_in_flight, rate_per_second)
+        self.in_flight: Dict[str, asyncio.Future] = {}
+
+    def configure(self, max_in_flight: int, rate_per_second: float):
+        """Set the limits, e.g. a share of them per process; call before the first request."""
+        self.max_in_flight = max_in_flight
+        self.rate_per_second = rate_per_second
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.bucket = TokenBucket(rate_per_second, self.burst)
+
+    @property
+    def client(self):
+        """OpenAI SDK client; the SDK is imported on first use, not at bot startup."""
+        if self._client is None:
+            from openai import AsyncOpenAI
+            # Повторы делаем сами, встроенные повторы SDK отключены
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                       max_retries=0, timeout=self.timeout)
+        return self._client
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_delay)
+        # Экспоненциальная задержка с полным джиттером
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _create(self, model: str, messages: List[Dict], **params):
+        async with self.semaphore:
+            await self.bucket.acquire()
+            return await self.client.chat.completions.create(model=model, messages=messages, **params)
+
+    async def _with_retries(self, model: str, messages: List[Dict], **params):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._create(model, messages, **params)
+            except Exception as e:
+                LLM_ERRORS.inc(model=model, kind=getattr(e, "status_code", None) or e.__class__.__name__)
+                if not _is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt, e)
+                print(f"Модель {model}: ошибка {e.__class__.__name__}, повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+
+    async def _complete(self, messages: List[Dict], **params) -> str:
+        last_error = None
+        for model in self.models:
+            try:
+                completion = await self._with_retries(model, messages, **params)
+                return completion.choices[0].message.content
+            except Exception as e:
+                print(f"Модель {model} недоступна: {str(e)}")
+                last_error = e
+        raise last_error
+
+    async def complete(self, messages: List[Dict], **params) -> str:
+        """Generate a full answer; identical concurrent requests share one API call."""
+        key = hashlib.sha256(json.dumps([messages, params], sort_keys=True, ensure_ascii=False)
+                             .encode("utf-8")).hexdigest()
+        future = self.in_flight.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await self._complete(messages, **params)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение передается ожидающим; помечаем его как полученное
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[key]
+
+    async def stream(self, messages: List[Dict], **params) -> AsyncIterator[str]:
+        """
+        Stream answer text. Retries and fallback models are used only until
+        the first token arrives; after that errors propagate to the caller.
+        """
+        last_error = None
+        for model in self.models:
+            for attempt in range(self.max_retries + 1):
+                received = False
+                try:
+                    async with self.semaphore:
+                        await self.bucket.acquire()
+                        stream = await self.client.chat.completions.create(
+                            model=model, messages=messages, stream=True, **params
+                        )
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                received = True
+                                yield delta
+                    return
+                except Exception as e:
+                    LLM_ERRORS.inc(model=model, kind=getattr(e, "status_code", None) or e.__class__.__name__)
+                    if received:
+                        raise
+                    last_error = e
+                    if not _is_retryable(e) or attempt == self.max_retries:
+                        print(f"Модель {model} недоступна: {str(e)}")
+                        break
+                    delay = self._backoff(attempt, e)
+                    print(f"Модель {model}: ошибка {e.__class__.__name__}, повтор через {delay:.1f} с")
+                    await asyncio.sleep(delay)
+        raise last_error
@@ -1,18 +1,19 @@
 import asyncio
 import argparse
-import os
 import json
-from data_loader import DataLoader
+import time
+from typing import Dict, List, Optional
+from data_loader import DataLoader, HYBRID_ALPHA, RETRIEVER_MODE
+from metrics import percentile
+
+# Сколько запросов с разными результатами показывать при сравнении конфигураций
+DIFF_SHOW_LIMIT = 10
 
 async def list_knowledge_base(data_dir: str):
     """Отображает содержимое базы знаний."""
     loader = DataLoader(data_dir)
-    if not os.path.exists(loader.kb_file):
-        print(f"База знаний не найдена в {loader.kb_file}")
-        return
-        
-    with open(loader.kb_file, 'r', encoding='utf-8') as f:
-        kb = json.load(f)
+    # Читаем только метаданные документов, без их содержимого
+    kb = loader.store.list_documents()
     
     if not kb:
         print("База знаний пуста")
@@ -27,23 +28,23 @@ async def list_knowledge_base(data_dir: str):
     if pdf_files:
         print("\nPDF файлы:")
         for f in pdf_files:
-            print(f"  - {f}")
+            print(f"  - {f} ({kb[f]['chars']} симв., {kb[f]['chunk_count']} фрагм.)")
     
     if img_files:
         print("\nИзображения:")
         for f in img_files:
-            print(f"  - {f}")
+            print(f"  - {f} ({kb[f]['chars']} симв., {kb[f]['chunk_count']} фрагм.)")
     
     if txt_files:
         print("\nТекстовые файлы:")
         for f in txt_files:
-            print(f"  - {f}")
+            print(f"  - {f} ({kb[f]['chars']} симв., {kb[f]['chunk_count']} фрагм.)")
 
 async def clear_knowledge_base(data_dir: str):
     """Очищает базу знаний."""
     loader = DataLoader(data_dir)
-    if not os.path.exists(loader.kb_file):
-        print(f"База знаний не найдена в {loader.kb_file}")
+    if loader.store.is_empty():
+        print(f"База знаний в {loader.db_file} пуста")
         return
         
     confirm = input("Вы уверены, что хотите очистить всю базу знаний? (да/нет): ")
@@ -51,16 +52,15 @@ async def clear_knowledge_base(data_dir: str):
         print("Операция отменена")
         return
         
-    # Сохраняем пустую базу знаний
-    loader.knowledge_base = {}
-    loader.save_knowledge_base()
+    # Удаляем все документы и перестраиваем индекс
+    loader.clear()
     print("База знаний очищена")
 
 async def test_query(data_dir: str, query: str):
     """Тестирует поиск по базе знаний."""
     loader = DataLoader(data_dir)
-    if not os.path.exists(loader.kb_file):
-        print(f"База знаний не найдена в {loader.kb_file}")
+    if loader.store.is_empty():
+        print(f"База знаний в {loader.db_file} пуста")
         return
         
     result = loader.search_knowledge_base(query)
@@ -70,6 +70,165 @@ async def test_query(data_dir: str, query: str):
     else:
         print("По вашему запросу ничего не найдено")
 
+def load_eval_queries(path: str) -> List[Dict]:
+    """
+    Читает запросы для пакетного поиска. JSONL: {"query": "...", "expected": ["файл.pdf", 42]},
+    где expected - имена файлов-источников или id фрагментов (необязательно). Иначе по запросу
+    в строке, ожидаемые ответы можно указать после табуляции через ";".
+    """
+    queries = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if path.endswith('.jsonl'):
+                item = json.loads(line)
+                expected = item.get('expected') or []
+                if not isinstance(expected, list):
+                    expected = [expected]
+                queries.append({"query": item['query'], "expected": [str(e) for e in expected]})
+            else:
+                query, _, expected = line.partition('\t')
+                queries.append({"query": query, "expected": [e.strip() for e in expected.split(';') if e.strip()]})
+    return queries
+
+def parse_config(spec: Optional[str], data_dir: str) -> Dict:
+    """Конфигурация поиска из строки вида "mode=bm25,alpha=0.3,data_dir=other_data"."""
+    config = {"name": spec or "по умолчанию", "mode": RETRIEVER_MODE, "alpha": HYBRID_ALPHA, "data_dir": data_dir}
+    for part in (spec or "").split(','):
+        if not part.strip():
+            continue
+        key, _, value = part.partition('=')
+        key = key.strip()
+        if key not in config or key == "name":
+            raise ValueError(f"Неизвестный параметр конфигурации: {key}")
+        config[key] = float(value) if key == "alpha" else value.strip()
+    return config
+
+def first_relevant_rank(results: List[Dict], expected: List[str]) -> Optional[int]:
+    for rank, result in enumerate(results, 1):
+        if result["source"] in expected or str(result["id"]) in expected:
+            return rank
+    return None
+
+def evaluate_config(config: Dict, queries: List[Dict], k: int) -> Dict:
+    """Качество (recall@k, MRR) по пакетному поиску и задержка каждого запроса в обычном режиме."""
+    loader = DataLoader(config["data_dir"])
+    texts = [item["query"] for item in queries]
+    
+    started = time.perf_counter()
+    rankings = loader.rank_batch(texts, top_k=k, mode=config["mode"], alpha=config["alpha"])
+    batch_seconds = time.perf_counter() - started
+    
+    # Задержка одного запроса - как при ответе бота, вместе с чтением фрагментов
+    latencies = []
+    for text in texts:
+        started = time.perf_counter()
+        loader.search_chunks(text, top_k=k, mode=config["mode"], alpha=config["alpha"])
+        latencies.append(time.perf_counter() - started)
+    
+    per_query = []
+    recalls, reciprocal_ranks, hits = [], [], []
+    for item, results, latency in zip(queries, rankings, latencies):
+        expected = item["expected"]
+        row = {"query": item["query"], "latency_ms": latency * 1000,
+               "results": [{"id": r["id"], "source": r["source"], "score": round(float(r["score"]), 4)}
+                           for r in results]}
+        if expected:
+            found = {e for e in expected for r in results if e in (r["source"], str(r["id"]))}
+            rank = first_relevant_rank(results, expected)
+            row.update(expected=expected, recall=len(found) / len(expected), rank=rank)
+            recalls.append(row["recall"])
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+            hits.append(1.0 if rank else 0.0)
+        per_query.append(row)
+    loader.store.close()
+    
+    return {
+        "config": config,
+        "chunks": len(loader.index.chunks),
+        "evaluated": len(recalls),
+        "recall": sum(recalls) / len(recalls) if recalls else None,
+        "hit_rate": sum(hits) / len(hits) if hits else None,
+        "mrr": sum(reciprocal_ranks) / len(reciprocal_ranks) if reciprocal_ranks else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+        "batch_queries_per_s": len(texts) / batch_seconds if batch_seconds else 0.0,
+        "queries": per_query
+    }
+
+def print_report(reports: List[Dict], k: int):
+    def fmt(value, digits=3):
+        return "-" if value is None else f"{value:.{digits}f}"
+    
+    rows = [
+        (f"recall@{k}", [fmt(r["recall"]) for r in reports]),
+        (f"hit@{k}", [fmt(r["hit_rate"]) for r in reports]),
+        ("MRR", [fmt(r["mrr"]) for r in reports]),
+        ("задержка p50, мс", [fmt(r["p50_ms"], 2) for r in reports]),
+        ("задержка p95, мс", [fmt(r["p95_ms"], 2) for r in reports]),
+        ("задержка max, мс", [fmt(r["max_ms"], 2) for r in reports]),
+        ("пакет, запросов/с", [fmt(r["batch_queries_per_s"], 0) for r in reports]),
+        ("фрагментов в индексе", [str(r["chunks"]) for r in reports]),
+    ]
+    names = [r["config"]["name"] for r in reports]
+    width = max(len(name) for name, _ in rows)
+    columns = [max(len(name), *(len(values[i]) for _, values in rows)) for i, name in enumerate(names)]
+    print(f"\n=== Оценка поиска: запросов {len(reports[0]['queries'])}, "
+          f"с ожидаемыми ответами {reports[0]['evaluated']} ===")
+    print(" | ".join([" " * width] + [name.rjust(c) for name, c in zip(names, columns)]))
+    for name, values in rows:
+        print(" | ".join([name.ljust(width)] + [value.rjust(c) for value, c in zip(values, columns)]))
+
+def print_differences(first: Dict, second: Dict):
+    """Запросы, для которых позиция первого правильного фрагмента отличается в двух конфигурациях."""
+    changed = [
+        (a["query"], a.get("rank"), b.get("rank"))
+        for a, b in zip(first["queries"], second["queries"])
+        if a.get("expected") and a.get("rank") != b.get("rank")
+    ]
+    if not changed:
+        print("\nПозиции правильных ответов в конфигурациях совпадают")
+        return
+    better = sum(1 for _, a, b in changed if b and (not a or b < a))
+    print(f"\nРазличаются {len(changed)} запросов: лучше во второй конфигурации {better}, "
+          f"хуже {len(changed) - better}")
+    for query, a, b in changed[:DIFF_SHOW_LIMIT]:
+        print(f"  {a or '-'} -> {b or '-'}: {query}")
+
+async def eval_queries(data_dir: str, path: str, k: int, configs: List[str], output: Optional[str]):
+    """Оценивает поиск по файлу запросов и сравнивает конфигурации."""
+    queries = load_eval_queries(path)
+    if not queries:
+        print(f"В {path} нет запросов")
+        return
+    reports = [
+        await asyncio.to_thread(evaluate_config, parse_config(spec, data_dir), queries, k)
+        for spec in (configs or [None])
+    ]
+    print_report(reports, k)
+    if len(reports) == 2:
+        print_differences(reports[0], reports[1])
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=1)
+        print(f"\nПодробный отчет сохранен в {output}")
+
+async def batch_queries(data_dir: str, path: str, k: int, config: Optional[str]):
+    """Ищет по всем запросам из файла и выводит источники найденных фрагментов по одной строке на запрос."""
+    queries = load_eval_queries(path)
+    report = await asyncio.to_thread(evaluate_config, parse_config(config, data_dir), queries, k)
+    for row in report["queries"]:
+        sources = ", ".join(f"{r['source']}#{r['id']}" for r in row["results"]) or "ничего не найдено"
+        mark = ""
+        if row.get("expected"):
+            mark = f" [позиция {row['rank']}]" if row["rank"] else " [не найдено]"
+        print(f"{row['latency_ms']:7.2f} мс | {row['query']}{mark}\n           {sources}")
+    print(f"\nЗапросов: {len(report['queries'])}, задержка p50 {report['p50_ms']:.2f} мс, "
+          f"p95 {report['p95_ms']:.2f} мс")
+
 async def main():
     parser = argparse.ArgumentParser(description='Управление базой знаний бота.')
     parser.add_argument('--data-dir', type=str, default='training_data',
@@ -87,6 +246,21 @@ async def main():
     test_parser = subparsers.add_parser('test', help='Протестировать поиск по базе знаний')
     test_parser.add_argument('query', type=str, help='Поисковый запрос')
     
+    # Команда batch
+    batch_parser = subparsers.add_parser('batch', help='Выполнить поиск по всем запросам из файла')
+    batch_parser.add_argument('queries', type=str, help='Файл запросов (.jsonl или по запросу в строке)')
+    batch_parser.add_argument('-k', type=int, default=5, help='Сколько фрагментов искать на запрос')
+    batch_parser.add_argument('--config', type=str, default=None,
+                              help='Конфигурация поиска, например "mode=bm25" или "mode=hybrid,alpha=0.7"')
+    
+    # Команда eval
+    eval_parser = subparsers.add_parser('eval', help='Оценить качество и скорость поиска: recall@k, MRR, задержка')
+    eval_parser.add_argument('queries', type=str, help='Файл запросов с ожидаемыми источниками или id фрагментов')
+    eval_parser.add_argument('-k', type=int, default=5, help='Сколько фрагментов учитывать')
+    eval_parser.add_argument('--config', type=str, action='append', default=[],
+                             help='Конфигурация (mode, alpha, data_dir); укажите дважды, чтобы сравнить две')
+    eval_parser.add_argument('--output', type=str, default=None, help='Сохранить подробный отчет в JSON')
+    
     args = parser.parse_args()
     
     if args.command == 'list':
@@ -95,6 +269,10 @@ async def main():
         await clear_knowledge_base(args.data_dir)
     elif args.command == 'test':
         await test_query(args.data_dir, args.query)
+    elif args.command == 'batch':
+        await batch_queries(args.data_dir, args.queries, args.k, args.config)
+    elif args.command == 'eval':
+        await eval_queries(args.data_dir, args.queries, args.k, args.config, args.output)
     else:
         parser.print_help()
 
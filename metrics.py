@@ -0,0 +1,233 @@
+import bisect
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Порт и адрес HTTP-эндпоинта /metrics
+METRICS_HOST = "127.0.0.1"
+# 9100 занят node_exporter; 0 отключает эндпоинт
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9321"))
+# Запросы дольше этого порога (сек) попадают в журнал трассировки
+SLOW_REQUEST_SECONDS = 5.0
+# Доля медленных запросов, для которых пишется трассировка
+TRACE_SAMPLE_RATE = 0.2
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000)
+
+
+def _label_key(labelnames: Tuple[str, ...], labels: Dict[str, Any]) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (counts per bucket, sum, count)
+        self.values: Dict[Tuple[str, ...], List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(self.labelnames, labels)
+        with self._lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, key, f'le="{bound}"')
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                inf_labels = _format_labels(self.labelnames, key, 'le="+Inf"')
+                lines.append(f"{self.name}_bucket{inf_labels} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "bot_stage_seconds", "Duration of processing stages", ("stage",))
+HANDLER_SECONDS = REGISTRY.histogram(
+    "bot_handler_seconds", "Duration of message handlers", ("handler",))
+TELEGRAM_SECONDS = REGISTRY.histogram(
+    "bot_telegram_request_seconds", "Duration of Telegram Bot API requests", ("method",))
+PROMPT_TOKENS = REGISTRY.histogram(
+    "bot_prompt_tokens", "Estimated prompt size in tokens", (), TOKEN_BUCKETS)
+CACHE_REQUESTS = REGISTRY.counter(
+    "bot_answer_cache_requests_total", "Answer cache lookups", ("result",))
+LLM_ERRORS = REGISTRY.counter(
+    "bot_llm_errors_total", "Errors returned by the LLM API", ("model", "kind"))
+HANDLER_ERRORS = REGISTRY.counter(
+    "bot_handler_errors_total", "Unhandled exceptions in message handlers", ("handler",))
+GENERATION_QUEUE_DROPPED = REGISTRY.counter(
+    "bot_generation_queue_dropped_total", "Generation requests dropped from the queue", ("reason",))
+
+# Трассировка текущего запроса: список (этап, длительность)
+_trace: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar("trace", default=None)
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Linearly interpolated q-quantile (0..1) of a sample; 0.0 for an empty one."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    low = int(position)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+
+def observe_stage(stage: str, seconds: float):
+    """Record a stage duration in the histogram and in the current request trace."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((stage, seconds))
+
+
+@contextmanager
+def timed(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+class HandlerMetricsMiddleware:
+    """aiogram middleware that times handlers and logs sampled traces of slow requests."""
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]], event: Any,
+                       data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        trace: List[Tuple[str, float]] = []
+        token = _trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _trace.reset(token)
+            HANDLER_SECONDS.observe(elapsed, handler=name)
+            if elapsed >= SLOW_REQUEST_SECONDS and random.random() < TRACE_SAMPLE_RATE:
+                stages = ", ".join(f"{stage}={seconds:.3f}s" for stage, seconds in trace)
+                logger.warning(f"Медленный запрос {name}: {elapsed:.3f}s ({stages})")
+
+
+class TelegramRequestMetrics:
+    """Bot session middleware that times every Telegram Bot API call."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - started
+            TELEGRAM_SECONDS.observe(elapsed, method=type(method).__name__)
+            observe_stage("telegram", elapsed)
+
+
+async def start_metrics_server(host: str = METRICS_HOST, port: int = METRICS_PORT):
+    """
+    Serve /metrics over HTTP; returns the aiohttp runner to clean up on shutdown,
+    or None if the endpoint is disabled or the port is unavailable.
+    """
+    from aiohttp import web
+
+    if not port:
+        return None
+
+    async def handle_metrics(request):
+        return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # Без метрик бот продолжает работать
+        logger.error(f"Не удалось запустить сервер метрик на {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return runner
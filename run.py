@@ -1,33 +1,109 @@
+import time
+# Время запуска отсчитывается от старта интерпретатора, до импорта тяжелых модулей
+STARTED = time.perf_counter()
+
+import argparse
 import asyncio
 import logging
 import sys
 from aiogram import Bot, Dispatcher
 from config import TG_TOKEN
-from handlers import router, init_data_loader
+from handlers import router, init_stores, set_data_loader, Gen
+from data_loader import DataLoader
+from session_store import SQLiteStorage
+from kb_watcher import KnowledgeWatcher
+from document_processor import DocumentProcessor
+from metrics import HandlerMetricsMiddleware, TelegramRequestMetrics, start_metrics_server
+
+IMPORTED = time.perf_counter()
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, 
                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class StartupTimer:
+    """Длительность этапов запуска бота для лога."""
+    
+    def __init__(self):
+        self.steps = [("импорт модулей", IMPORTED - STARTED)]
+        self.last = time.perf_counter()
+    
+    def step(self, name: str):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last))
+        self.last = now
+    
+    def report(self) -> str:
+        steps = ", ".join(f"{name} {seconds:.2f} с" for name, seconds in self.steps)
+        return f"Запуск занял {time.perf_counter() - STARTED:.2f} с ({steps})"
+
 async def main():
+    timer = StartupTimer()
     try:
         # Инициализируем бота и диспетчер
         bot = Bot(token=TG_TOKEN)
-        dp = Dispatcher()
+        # Состояния диалогов хранятся в SQLite и переживают перезапуск;
+        # генерации, прерванные остановкой бота, уже не завершатся
+        storage = SQLiteStorage()
+        storage.reset_state(Gen.wait.state)
+        init_stores()
+        dp = Dispatcher(storage=storage)
         dp.include_router(router)
         
-        # Загружаем базу знаний
+        # Метрики: время обработчиков, этапов и запросов к Telegram
+        router.message.middleware(HandlerMetricsMiddleware())
+        bot.session.middleware(TelegramRequestMetrics())
+        timer.step("хранилище состояний")
+        metrics_runner = await start_metrics_server()
+        timer.step("сервер метрик")
+        
+        # Загружаем базу знаний из сохраненного снимка индекса, без обработки файлов;
+        # если снимка нет (первый запуск, миграция), строим индекс по уже обработанным фрагментам
+        # здесь, в потоке, а не при первом поиске в цикле событий
         logger.info("Загрузка базы знаний...")
-        await init_data_loader()
+        loader = await asyncio.to_thread(DataLoader, "training_data")
+        if loader.index is None:
+            await asyncio.to_thread(loader.rebuild_index)
+        set_data_loader(loader)
+        timer.step("база знаний")
         logger.info("База знаний загружена")
         
+        # Файлы, измененные пока бот был остановлен, обрабатываются в фоне уже после запуска;
+        # дальше следим за новыми файлами в training_data и подгружаем их без перезапуска
+        watcher = KnowledgeWatcher("training_data", set_data_loader, catch_up=True)
+        watcher.start()
+        
+        async def on_startup():
+            timer.step("подготовка к опросу")
+            logger.info(timer.report())
+        dp.startup.register(on_startup)
+        
         # Запускаем бота
         logger.info("Бот запущен")
-        await dp.start_polling(bot)
+        try:
+            await dp.start_polling(bot)
+        finally:
+            await watcher.stop()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await storage.close()
     except Exception as e:
         logger.error(f"Произошла ошибка при запуске бота: {e}")
         sys.exit(1)
+    finally:
+        # Останавливаем процессы обработки документов
+        DocumentProcessor.shutdown()
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Запуск Telegram-бота.')
+    parser.add_argument('--webhook', action='store_true',
+                        help='Принимать обновления через вебхук в нескольких процессах вместо long polling')
+    parser.add_argument('--workers', type=int, default=None, help='Количество процессов-обработчиков в режиме вебхука')
+    args = parser.parse_args()
+    
+    if args.webhook:
+        from webhook_server import serve, WORKER_COUNT
+        serve(args.workers or WORKER_COUNT)
+    else:
+        asyncio.run(main())
\ No newline at end of file
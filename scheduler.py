@@ -0,0 +1,187 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Deque, Dict, Hashable, Optional
+
+from metrics import GENERATION_QUEUE_DROPPED, observe_stage
+
+# Одновременных генераций на хост (в режиме вебхука делится между процессами-обработчиками)
+MAX_CONCURRENT_GENERATIONS = 4
+# Сколько запрос может ждать в очереди (сек); дольше пользователь обычно уже не ждет ответа
+QUEUE_DEADLINE = 120
+# За каждые столько секунд ожидания приоритет запроса повышается на уровень, чтобы тяжелые запросы не ждали вечно
+PRIORITY_AGING = 30
+# Как часто сообщать пользователю его место в очереди (сек)
+POSITION_UPDATE_INTERVAL = 5
+
+# Приоритеты: меньше - раньше
+PRIORITY_SHORT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_DOCUMENT = 2
+# Фоновая работа (сводки разговоров) - после всех запросов пользователей
+PRIORITY_BACKGROUND = 3
+# Вопрос вместе с найденным контекстом не длиннее стольких токенов считается коротким
+SHORT_PROMPT_TOKENS = 800
+
+
+def priority_for(prompt_tokens: int, document: bool = False) -> int:
+    """Questions about uploaded documents go last, short knowledge base questions first."""
+    if document:
+        return PRIORITY_DOCUMENT
+    return PRIORITY_SHORT if prompt_tokens <= SHORT_PROMPT_TOKENS else PRIORITY_NORMAL
+
+
+class QueueDropped(Exception):
+    """A queued request was dropped: reason is "timeout" or "cancelled"."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _Ticket:
+    __slots__ = ("user_id", "priority", "enqueued", "deadline", "granted")
+
+    def __init__(self, user_id: Hashable, priority: int, deadline: float):
+        self.user_id = user_id
+        self.priority = priority
+        self.enqueued = time.monotonic()
+        self.deadline = self.enqueued + deadline
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class GenerationScheduler:
+    """
+    Admits generation requests under a concurrency cap. Waiting requests are
+    kept in one queue per user; the next slot goes to the user whose head
+    request has the best priority (improved by waiting time), ties broken in
+    favour of the user served least recently, so one user's burst can't
+    starve others. Requests are dropped after their deadline or when the
+    user cancels them.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_GENERATIONS, deadline: float = QUEUE_DEADLINE,
+                 aging: float = PRIORITY_AGING):
+        self.max_concurrent = max_concurrent
+        self.deadline = deadline
+        self.aging = aging
+        self.active = 0
+        self.queues: Dict[Hashable, Deque[_Ticket]] = {}
+        self.last_served: Dict[Hashable, float] = {}
+
+    def configure(self, max_concurrent: int):
+        self.max_concurrent = max_concurrent
+        self._dispatch()
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def _rank(self, ticket: _Ticket, now: float):
+        aged = int((now - ticket.enqueued) // self.aging) if self.aging else 0
+        return (ticket.priority - aged, self.last_served.get(ticket.user_id, 0.0), ticket.enqueued)
+
+    def _remove(self, ticket: _Ticket):
+        queue = self.queues.get(ticket.user_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        if not queue:
+            del self.queues[ticket.user_id]
+
+    def _drop(self, ticket: _Ticket, reason: str):
+        self._remove(ticket)
+        GENERATION_QUEUE_DROPPED.inc(reason=reason)
+        if not ticket.granted.done():
+            ticket.granted.set_exception(QueueDropped(reason))
+
+    def _dispatch(self):
+        now = time.monotonic()
+        for queue in list(self.queues.values()):
+            for ticket in [ticket for ticket in queue if ticket.deadline <= now]:
+                self._drop(ticket, "timeout")
+        while self.active < self.max_concurrent and self.queues:
+            ticket = min((queue[0] for queue in self.queues.values()), key=lambda t: self._rank(t, now))
+            self._remove(ticket)
+            self.active += 1
+            self.last_served[ticket.user_id] = now
+            ticket.granted.set_result(None)
+        # Пользователи без запросов в очереди больше не влияют на порядок
+        if not self.queues and not self.active:
+            self.last_served.clear()
+
+    def position(self, ticket: _Ticket) -> int:
+        """Estimated place of a waiting request in the queue, starting from 1."""
+        now = time.monotonic()
+        rank = self._rank(ticket, now)
+        ahead = sum(
+            1 for queue in self.queues.values() for other in queue
+            if other is not ticket and self._rank(other, now) < rank
+        )
+        return ahead + 1
+
+    def cancel(self, user_id: Hashable) -> int:
+        """Drop all waiting requests of a user, e.g. when they gave up waiting."""
+        tickets = list(self.queues.get(user_id, ()))
+        for ticket in tickets:
+            self._drop(ticket, "cancelled")
+        return len(tickets)
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    async def _acquire(self, user_id: Hashable, priority: int,
+                       on_position: Optional[Callable[[int], Awaitable[None]]]):
+        if self.active < self.max_concurrent and not self.queues:
+            self.active += 1
+            self.last_served[user_id] = time.monotonic()
+            return
+
+        ticket = _Ticket(user_id, priority, self.deadline)
+        self.queues.setdefault(user_id, deque()).append(ticket)
+        reported = None
+        try:
+            while True:
+                remaining = ticket.deadline - time.monotonic()
+                if remaining <= 0:
+                    self._drop(ticket, "timeout")
+                elif on_position is not None and not ticket.granted.done():
+                    position = self.position(ticket)
+                    if position != reported:
+                        reported = position
+                        await on_position(position)
+                try:
+                    await asyncio.wait_for(asyncio.shield(ticket.granted),
+                                           timeout=max(0.0, min(POSITION_UPDATE_INTERVAL, remaining)))
+                    break
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            # Обработчик отменен (например, при остановке бота) или запрос отброшен: освобождаем место или слот
+            granted = ticket.granted
+            if granted.done() and not granted.cancelled() and granted.exception() is None:
+                self._release()
+            else:
+                self._remove(ticket)
+            raise
+        finally:
+            observe_stage("generation_queue", time.monotonic() - ticket.enqueued)
+
+    @asynccontextmanager
+    async def slot(self, user_id: Hashable, priority: int = PRIORITY_NORMAL,
+                   on_position: Optional[Callable[[int], Awaitable[None]]] = None):
+        """
+        Hold a generation slot for the duration of the block. on_position is
+        awaited with the request's place in the queue whenever it changes;
+        raises QueueDropped if the request times out or is cancelled.
+        """
+        await self._acquire(user_id, priority, on_position)
+        try:
+            yield
+        finally:
+            self._release()
@@ -0,0 +1,253 @@
+import json
+import os
+import re
+import struct
+import time
+import uuid
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# Токены: слова из кириллицы/латиницы и числа
+TOKEN_RE = re.compile(r"[0-9a-zа-яё]+")
+
+# Пустые строки (в т.ч. из одних пробелов) разделяют абзацы
+PARAGRAPH_RE = re.compile(r"\n[ \t\r\f\v]*\n")
+
+# Заголовок файла индекса: сигнатура и длина JSON-части
+SNAPSHOT_MAGIC = b"SWIDX001"
+SNAPSHOT_HEADER = struct.Struct("<8sQ")
+
+# Окончания для упрощенного стемминга русских слов (от длинных к коротким)
+RUSSIAN_ENDINGS = tuple(sorted((
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях",
+    "ого", "его", "ому", "ему", "ыми", "ими", "ых", "их",
+    "ая", "яя", "ое", "ее", "ие", "ые", "ой", "ей", "ий", "ый",
+    "ом", "ем", "ам", "ям", "ах", "ях", "ую", "юю", "ов", "ев",
+    "ью", "ия", "ья", "ии",
+    "а", "я", "о", "е", "ы", "и", "у", "ю", "ь", "й",
+), key=len, reverse=True))
+
+MIN_STEM_LENGTH = 3
+
+STOP_WORDS = {
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то",
+    "все", "она", "так", "его", "но", "да", "ты", "к", "у", "же", "вы", "за",
+    "бы", "по", "только", "ее", "мне", "было", "вот", "от", "меня", "еще",
+    "нет", "о", "об", "из", "ему", "ли", "если", "уже", "или", "ни", "быть",
+    "был", "до", "вас", "для", "это", "мы", "есть", "при", "без", "там",
+    "тут", "где", "кто", "чем", "их", "мой", "ваш", "какой", "какие", "такое",
+    "the", "a", "an", "and", "or", "of", "to", "in", "is",
+}
+
+
+def normalize_token(token: str) -> str:
+    """Normalize a single lowercase token: fold 'ё' and strip common Russian endings."""
+    token = token.replace("ё", "е")
+    if token.isdigit():
+        return token
+    for ending in RUSSIAN_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= MIN_STEM_LENGTH:
+            return token[:-len(ending)]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into normalized search terms, dropping stop words."""
+    terms = []
+    for token in TOKEN_RE.findall(text.lower()):
+        if token in STOP_WORDS:
+            continue
+        if len(token) < 2 and not token.isdigit():
+            continue
+        terms.append(normalize_token(token))
+    return terms
+
+
+def _clean_whitespace(text: str) -> str:
+    lines = [" ".join(line.split()) for line in text.splitlines()]
+    return "\n".join(line for line in lines if line)
+
+
+def split_into_chunks(text: str, max_chars: int = 1200) -> List[str]:
+    """
+    Split a document into paragraph-sized chunks of at most max_chars.
+    Small neighbouring paragraphs are merged, oversized ones are split by lines.
+    """
+    pieces = []
+    for paragraph in PARAGRAPH_RE.split(text):
+        paragraph = _clean_whitespace(paragraph)
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        # Слишком длинный абзац режем по строкам, а очень длинные строки - по длине
+        for line in paragraph.split("\n"):
+            while len(line) > max_chars:
+                cut = line.rfind(" ", 0, max_chars)
+                if cut <= 0:
+                    cut = max_chars
+                pieces.append(line[:cut])
+                line = line[cut:].strip()
+            if line:
+                pieces.append(line)
+
+    chunks = []
+    current = []
+    current_len = 0
+    for piece in pieces:
+        if current and current_len + len(piece) + 1 > max_chars:
+            chunks.append("\n".join(current))
+            current = []
+            current_len = 0
+        current.append(piece)
+        current_len += len(piece) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class SearchIndex:
+    """
+    Inverted index over knowledge base chunks with BM25 ranking. Postings are
+    collected in dicts while building and compiled by finalize() into flat
+    numpy arrays (CSR layout: per-term slices of chunk positions and term
+    frequencies), which is also the on-disk format, so a saved index loads
+    with one read and no per-posting Python objects.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # Chunk metadata by index position; chunk texts live in the knowledge store
+        self.chunks: List[Dict] = []
+        # term -> [[position, term_frequency], ...], only while building
+        self.postings: Dict[str, List[List[int]]] = {}
+        self.lengths: List[int] = []
+        # Compiled index: term -> row; postings of row r are positions/tfs[offsets[r]:offsets[r + 1]]
+        self.terms: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.positions = np.zeros(0, dtype=np.int32)
+        self.tfs = np.zeros(0, dtype=np.int32)
+        self.chunk_lengths = np.zeros(0, dtype=np.int32)
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.length_norm = np.zeros(0, dtype=np.float32)
+        # Меняется при каждой перестройке индекса
+        self.version = str(time.time_ns())
+
+    @classmethod
+    def build(cls, chunks: Iterable[Tuple[int, str, str]]) -> "SearchIndex":
+        """Index (chunk_id, source, text) triples."""
+        index = cls()
+        for chunk_id, source, text in chunks:
+            index.add_chunk(chunk_id, source, text)
+        index.finalize()
+        return index
+
+    def add_chunk(self, chunk_id: int, source: str, text: str) -> int:
+        position = len(self.chunks)
+        terms = tokenize(text)
+        self.chunks.append({"id": chunk_id, "source": source})
+        self.lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, []).append([position, tf])
+        return position
+
+    def finalize(self):
+        """Compile collected postings into arrays and precompute per-term and per-chunk BM25 factors."""
+        terms = list(self.postings)
+        self.terms = {term: row for row, term in enumerate(terms)}
+        counts = np.array([len(self.postings[term]) for term in terms], dtype=np.int64)
+        self.offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        flat = np.array([pair for term in terms for pair in self.postings[term]], dtype=np.int32).reshape(-1, 2)
+        self.positions = np.ascontiguousarray(flat[:, 0])
+        self.tfs = np.ascontiguousarray(flat[:, 1])
+        self.chunk_lengths = np.array(self.lengths, dtype=np.int32)
+        self.postings = {}
+        self.lengths = []
+        self._precompute()
+
+    def _precompute(self):
+        """IDF and length normalization once, so queries do no corpus-wide work."""
+        total = len(self.chunks)
+        counts = np.diff(self.offsets)
+        self.idf = np.log(1 + (total - counts + 0.5) / (counts + 0.5)).astype(np.float32)
+        avg_length = float(self.chunk_lengths.mean()) if total else 0.0
+        self.length_norm = (self.k1 * (1 - self.b + self.b * self.chunk_lengths / (avg_length or 1.0))).astype(np.float32)
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[int, float]]:
+        """Return (position, score) pairs of the best matching chunks."""
+        if not self.chunks:
+            return []
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        matched = False
+        for term in set(tokenize(query)):
+            row = self.terms.get(term)
+            if row is None:
+                continue
+            start, end = self.offsets[row], self.offsets[row + 1]
+            positions = self.positions[start:end]
+            tfs = self.tfs[start:end]
+            # Позиции в списке одного термина уникальны, поэтому сложение по индексам корректно
+            scores[positions] += self.idf[row] * tfs * (self.k1 + 1) / (tfs + self.length_norm[positions])
+            matched = True
+        if not matched:
+            return []
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(scores[candidates], -top_k)[-top_k:]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(position), float(scores[position])) for position in candidates]
+
+    def save(self, path: str):
+        """Save index to a single binary file: JSON header followed by the posting arrays."""
+        arrays = (self.offsets, self.positions, self.tfs, self.chunk_lengths)
+        header = json.dumps({
+            "k1": self.k1,
+            "b": self.b,
+            "version": self.version,
+            "chunks": self.chunks,
+            "terms": list(self.terms),
+            "arrays": [[str(array.dtype), len(array)] for array in arrays],
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # Массивы выравниваются по 8 байт, чтобы читать их без копирования
+        header += b" " * (-(SNAPSHOT_HEADER.size + len(header)) % 8)
+        # Уникальное имя: индекс могут одновременно перестраивать запуск бота и наблюдатель
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, len(header)))
+            f.write(header)
+            for array in arrays:
+                f.write(array.tobytes())
+                f.write(b"\0" * (-array.nbytes % 8))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional["SearchIndex"]:
+        """Load index from file, or return None if it does not exist or has an old format."""
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        magic, header_length = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        offset = SNAPSHOT_HEADER.size
+        header = json.loads(data[offset:offset + header_length])
+        offset += header_length
+        arrays = []
+        for dtype, count in header["arrays"]:
+            array = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            arrays.append(array)
+            offset += array.nbytes + (-array.nbytes % 8)
+
+        index = cls(header["k1"], header["b"])
+        index.version = header["version"]
+        index.chunks = header["chunks"]
+        index.terms = {term: row for row, term in enumerate(header["terms"])}
+        index.offsets, index.positions, index.tfs, index.chunk_lengths = arrays
+        index._precompute()
+        return index
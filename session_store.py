@@ -0,0 +1,290 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+# Файл базы с состояниями диалогов и текстами загруженных пользователями документов
+STATE_DB_FILE = "bot_state.db"
+# Сколько хранится текст загруженного документа (сек)
+CONTEXT_TTL = 24 * 60 * 60
+# Максимальная длина текста одного документа (символов); остальное отбрасывается
+CONTEXT_MAX_CHARS = 200_000
+# Максимальный суммарный размер сохраненных текстов (байт, после сжатия)
+CONTEXT_STORE_MAX_BYTES = 100 * 1024 * 1024
+# Сколько хранится история разговора после последнего сообщения (сек)
+CONVERSATION_TTL = 24 * 60 * 60
+# Сколько последних обменов репликами хранить на чат; более старые должны быть уже в сводке
+CONVERSATION_MAX_TURNS = 12
+# Длина сохраняемого ответа (символов): для понимания уточняющих вопросов полный ответ не нужен
+TURN_ANSWER_MAX_CHARS = 1200
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}',
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS contexts (
+    id TEXT PRIMARY KEY,
+    content BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contexts_expires ON contexts(expires);
+CREATE TABLE IF NOT EXISTS conversation_turns (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversation_turns_chat ON conversation_turns(chat, seq);
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    chat TEXT PRIMARY KEY,
+    summary TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+def _connect(db_file: str) -> sqlite3.Connection:
+    # Несколько процессов бота работают с одной базой: WAL и ожидание блокировки
+    conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    aiogram FSM storage in SQLite: dialog states survive restarts and are
+    shared by all bot processes on the host. Data must stay small; document
+    texts go to ContextStore and only their id is kept here.
+    """
+
+    def __init__(self, db_file: str = STATE_DB_FILE):
+        self.db_file = db_file
+        self._lock = threading.Lock()
+        self.conn = _connect(db_file)
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    def _set_state(self, key: str, value: Optional[str]):
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO fsm (key, state, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                (key, value, time.time())
+            )
+
+    def _set_data(self, key: str, data: str):
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO fsm (key, data, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                (key, data, time.time())
+            )
+
+    def _get(self, column: str, key: str):
+        with self._lock:
+            row = self.conn.execute(f"SELECT {column} FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    # Запросы к базе выполняются в потоке: при блокировке файла другим процессом
+    # ожидание не должно останавливать цикл событий
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await asyncio.to_thread(self._set_state, self._key(key), value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return await asyncio.to_thread(self._get, "state", self._key(key))
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        await asyncio.to_thread(self._set_data, self._key(key), json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = await asyncio.to_thread(self._get, "data", self._key(key))
+        return json.loads(data) if data else {}
+
+    def reset_state(self, state: str) -> int:
+        """Clear the given state for every chat, e.g. generations interrupted by a restart."""
+        with self._lock:
+            return self.conn.execute("UPDATE fsm SET state = NULL WHERE state = ?", (state,)).rowcount
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close)
+
+    def _close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class ContextStore:
+    """
+    Texts of documents uploaded by users, stored compressed in SQLite with
+    a TTL, a per-document length cap and a total size cap (oldest evicted
+    first). The FSM state keeps only the returned context id.
+    """
+
+    def __init__(self, db_file: str = STATE_DB_FILE, ttl: float = CONTEXT_TTL,
+                 max_chars: int = CONTEXT_MAX_CHARS, max_bytes: int = CONTEXT_STORE_MAX_BYTES):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_chars = max_chars
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.conn = _connect(db_file)
+
+    def put(self, text: str) -> str:
+        context_id = uuid.uuid4().hex
+        content = zlib.compress(text[:self.max_chars].encode('utf-8'))
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute("DELETE FROM contexts WHERE expires <= ?", (now,))
+                self.conn.execute(
+                    "INSERT INTO contexts (id, content, size, created, expires) VALUES (?, ?, ?, ?, ?)",
+                    (context_id, content, len(content), now, now + self.ttl)
+                )
+                self._evict()
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return context_id
+
+    def _evict(self):
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM contexts").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self.conn.execute("SELECT id, size FROM contexts ORDER BY created DESC").fetchall()
+        # Оставляем самые новые документы, пока они помещаются в лимит
+        kept = 0
+        for context_id, size in rows:
+            kept += size
+            if kept > self.max_bytes:
+                self.conn.execute("DELETE FROM contexts WHERE id = ?", (context_id,))
+
+    def get(self, context_id: Optional[str]) -> Optional[str]:
+        if not context_id:
+            return None
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT content FROM contexts WHERE id = ? AND expires > ?", (context_id, time.time())
+            ).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8') if row else None
+
+    def delete(self, context_id: Optional[str]):
+        if not context_id:
+            return
+        with self._lock:
+            self.conn.execute("DELETE FROM contexts WHERE id = ?", (context_id,))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class ConversationStore:
+    """
+    Per-chat conversation history: the most recent question/answer turns
+    (answers truncated, at most max_turns) and a rolling summary of older
+    turns. History expires ttl seconds after the last turn.
+    """
+
+    def __init__(self, db_file: str = STATE_DB_FILE, ttl: float = CONVERSATION_TTL,
+                 max_turns: int = CONVERSATION_MAX_TURNS, answer_max_chars: int = TURN_ANSWER_MAX_CHARS):
+        self.db_file = db_file
+        self.ttl = ttl
+        self.max_turns = max_turns
+        self.answer_max_chars = answer_max_chars
+        self._lock = threading.Lock()
+        self.conn = _connect(db_file)
+
+    def get(self, chat: str) -> Tuple[str, List[Dict]]:
+        """Summary and turns (oldest first) of a chat; empty if the history expired."""
+        with self._lock:
+            turns = self.conn.execute(
+                "SELECT seq, question, answer, created FROM conversation_turns WHERE chat = ? ORDER BY seq",
+                (chat,)
+            ).fetchall()
+            row = self.conn.execute(
+                "SELECT summary, updated FROM conversation_summaries WHERE chat = ?", (chat,)
+            ).fetchone()
+        last = max([turns[-1][3] if turns else 0.0, row[1] if row else 0.0])
+        if time.time() - last > self.ttl:
+            if turns or row:
+                self.clear(chat)
+            return "", []
+        return (row[0] if row else ""), [
+            {"seq": seq, "question": question, "answer": answer} for seq, question, answer, _ in turns
+        ]
+
+    def append(self, chat: str, question: str, answer: str):
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.execute(
+                    "INSERT INTO conversation_turns (chat, question, answer, created) VALUES (?, ?, ?, ?)",
+                    (chat, question, answer[:self.answer_max_chars], now)
+                )
+                # Если сводка не успевает обновляться, самые старые реплики просто отбрасываются
+                self.conn.execute(
+                    "DELETE FROM conversation_turns WHERE chat = ? AND seq NOT IN "
+                    "(SELECT seq FROM conversation_turns WHERE chat = ? ORDER BY seq DESC LIMIT ?)",
+                    (chat, chat, self.max_turns)
+                )
+                self.conn.execute("DELETE FROM conversation_turns WHERE created <= ?", (now - self.ttl,))
+                self.conn.execute("DELETE FROM conversation_summaries WHERE updated <= ?", (now - self.ttl,))
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def set_summary(self, chat: str, summary: str, up_to_seq: int) -> bool:
+        """
+        Replace turns up to and including up_to_seq with a summary of them.
+        Nothing is changed if that turn is gone (history cleared or trimmed meanwhile).
+        """
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                exists = self.conn.execute(
+                    "SELECT 1 FROM conversation_turns WHERE chat = ? AND seq = ?", (chat, up_to_seq)
+                ).fetchone()
+                if exists is None:
+                    self.conn.execute("ROLLBACK")
+                    return False
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO conversation_summaries (chat, summary, updated) VALUES (?, ?, ?)",
+                    (chat, summary, time.time())
+                )
+                self.conn.execute("DELETE FROM conversation_turns WHERE chat = ? AND seq <= ?", (chat, up_to_seq))
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return True
+
+    def clear(self, chat: str):
+        with self._lock:
+            self.conn.execute("DELETE FROM conversation_turns WHERE chat = ?", (chat,))
+            self.conn.execute("DELETE FROM conversation_summaries WHERE chat = ?", (chat,))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
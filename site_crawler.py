@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import asyncio
+import hashlib
+import argparse
+import time
+from typing import Dict, List, Optional, Set
+from urllib.parse import urljoin, urldefrag, urlparse
+from urllib.robotparser import RobotFileParser
+
+import aiohttp
+from bs4 import BeautifulSoup
+
+# Официальный сайт компании; обходятся только страницы под этим адресом
+SITE_URL = "https://ru.siberianhealth.com/ru/"
+# Страницы, текст которых попадает в базу знаний (остальные используются только для поиска ссылок)
+PRODUCT_URL_PATTERNS = (r"/shop/catalog/product/",)
+# Максимум страниц за один обход
+CRAWL_MAX_PAGES = 500
+# Одновременных запросов к сайту
+CRAWL_CONCURRENCY = 4
+# Пауза между запросами одного обработчика (сек), чтобы не нагружать сайт
+CRAWL_DELAY = 0.5
+CRAWL_TIMEOUT = 20
+USER_AGENT = "SiberianWellnessBot/1.0 (+knowledge base crawler)"
+# Поддиректория training_data, куда сохраняется текст страниц
+SITE_SUBDIR = "site"
+# Кэш обхода: ETag, Last-Modified, ссылки и файл каждой страницы
+CACHE_FILE = "site_cache.json"
+
+# Элементы страницы, не относящиеся к содержимому
+SKIP_TAGS = ("script", "style", "noscript", "nav", "header", "footer", "form", "svg", "iframe")
+
+
+def normalize_url(url: str) -> str:
+    url, _ = urldefrag(url)
+    return url
+
+
+def page_filename(url: str) -> str:
+    """Stable file name for a page: readable part of the path plus a short hash of the URL."""
+    slug = re.sub(r"[^\w-]+", "_", urlparse(url).path).strip("_")[-80:] or "index"
+    return f"{slug}_{hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]}.txt"
+
+
+def extract_page(html: str, url: str) -> Dict:
+    """Title, main text and outgoing links of an HTML page."""
+    soup = BeautifulSoup(html, "html.parser")
+    links = []
+    for a in soup.find_all("a", href=True):
+        try:
+            links.append(normalize_url(urljoin(url, a["href"])))
+        except ValueError:
+            # Некорректная ссылка (например, "http://[broken") не должна мешать разбору страницы
+            continue
+    for tag in soup(SKIP_TAGS):
+        tag.decompose()
+    heading = soup.find("h1")
+    title = (heading or soup.title).get_text(" ", strip=True) if (heading or soup.title) else ""
+    body = soup.find("main") or soup.body or soup
+    lines = [" ".join(line.split()) for line in body.get_text("\n").splitlines()]
+    text = "\n".join(line for line in lines if line)
+    return {"title": title, "text": text, "links": links}
+
+
+class SiteCrawler:
+    """
+    Crawls the official site with a pooled aiohttp session and a fixed number
+    of workers. Pages are fetched with conditional GETs (ETag/Last-Modified)
+    against a local cache, so unchanged pages cost one 304 response. Product
+    pages are saved as text files in training_data/site, which DataLoader
+    ingests like any other text document.
+    """
+
+    def __init__(self, data_dir: str = "training_data", site_url: str = SITE_URL,
+                 max_pages: int = CRAWL_MAX_PAGES, concurrency: int = CRAWL_CONCURRENCY,
+                 delay: float = CRAWL_DELAY, product_patterns=PRODUCT_URL_PATTERNS):
+        self.site_url = site_url
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.delay = delay
+        self.product_patterns = [re.compile(pattern) for pattern in product_patterns]
+        self.pages_dir = os.path.join(data_dir, SITE_SUBDIR)
+        self.cache_file = os.path.join(data_dir, CACHE_FILE)
+        os.makedirs(self.pages_dir, exist_ok=True)
+        self.cache: Dict[str, Dict] = self._load_cache()
+        self.robots: Optional[RobotFileParser] = None
+        self.stats = {"fetched": 0, "not_modified": 0, "saved": 0, "removed": 0, "errors": 0}
+
+    def _load_cache(self) -> Dict[str, Dict]:
+        if not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_cache(self):
+        tmp_path = self.cache_file + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.cache, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.cache_file)
+
+    def in_scope(self, url: str) -> bool:
+        if not url.startswith(self.site_url):
+            return False
+        return self.robots is None or self.robots.can_fetch(USER_AGENT, url)
+
+    def is_product(self, url: str) -> bool:
+        return any(pattern.search(url) for pattern in self.product_patterns)
+
+    async def _load_robots(self, session: aiohttp.ClientSession):
+        parsed = urlparse(self.site_url)
+        try:
+            async with session.get(f"{parsed.scheme}://{parsed.netloc}/robots.txt") as response:
+                if response.status != 200:
+                    return
+                robots = RobotFileParser()
+                robots.parse((await response.text()).splitlines())
+                self.robots = robots
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+
+    def _write_page(self, url: str, page: Dict) -> Optional[str]:
+        """Save page text; returns the file name, or None if the page has no text."""
+        if not page["text"]:
+            return None
+        filename = page_filename(url)
+        content = f"{page['title']}\nИсточник: {url}\n\n{page['text']}\n"
+        path = os.path.join(self.pages_dir, filename)
+        # Неизмененный текст не перезаписываем, чтобы не переиндексировать файл
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                if f.read() == content:
+                    return filename
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self.stats["saved"] += 1
+        return filename
+
+    def _remove_page(self, url: str):
+        entry = self.cache.pop(url, None)
+        if entry and entry.get("file"):
+            path = os.path.join(self.pages_dir, entry["file"])
+            if os.path.exists(path):
+                os.remove(path)
+                self.stats["removed"] += 1
+
+    async def fetch(self, session: aiohttp.ClientSession, url: str) -> List[str]:
+        """Fetch one page (conditionally) and return its links."""
+        entry = self.cache.get(url, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        async with session.get(url, headers=headers) as response:
+            if response.status == 304:
+                self.stats["not_modified"] += 1
+                entry["checked"] = time.time()
+                return entry.get("links", [])
+            if response.status in (404, 410):
+                self._remove_page(url)
+                return []
+            if response.status != 200 or "html" not in response.headers.get("Content-Type", ""):
+                return []
+            html = await response.text(errors="replace")
+            final_url = normalize_url(str(response.url))
+            if final_url != url and not self.in_scope(final_url):
+                return []
+            etag, last_modified = response.headers.get("ETag"), response.headers.get("Last-Modified")
+
+        self.stats["fetched"] += 1
+        # Разбор HTML - работа для процессора, выполняем вне цикла событий
+        page = await asyncio.to_thread(extract_page, html, url)
+        links = sorted({link for link in page["links"] if self.in_scope(link)})
+        filename = None
+        if self.is_product(url):
+            filename = await asyncio.to_thread(self._write_page, url, page)
+        self.cache[url] = {
+            "etag": etag, "last_modified": last_modified, "links": links,
+            "file": filename, "checked": time.time()
+        }
+        return links
+
+    async def crawl(self) -> Dict:
+        timeout = aiohttp.ClientTimeout(total=CRAWL_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector,
+                                         headers={"User-Agent": USER_AGENT}) as session:
+            await self._load_robots(session)
+            queue: asyncio.Queue = asyncio.Queue()
+            seen: Set[str] = {self.site_url}
+            queue.put_nowait(self.site_url)
+
+            async def worker():
+                while True:
+                    url = await queue.get()
+                    try:
+                        for link in await self.fetch(session, url):
+                            if link not in seen and len(seen) < self.max_pages:
+                                seen.add(link)
+                                queue.put_nowait(link)
+                    except Exception as e:
+                        # Любая ошибка страницы (сеть, разбор, запись файла) не должна останавливать обработчик,
+                        # иначе очередь никогда не опустеет
+                        self.stats["errors"] += 1
+                        print(f"Error fetching {url}: {e!r}")
+                    finally:
+                        queue.task_done()
+                    await asyncio.sleep(self.delay)
+
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            try:
+                await queue.join()
+            finally:
+                for task in workers:
+                    task.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+
+        await asyncio.to_thread(self._save_cache)
+        self.stats["pages"] = len(seen)
+        return self.stats
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Загрузка страниц продуктов с официального сайта в базу знаний.')
+    parser.add_argument('--data-dir', type=str, default='training_data', help='Директория с обучающими данными')
+    parser.add_argument('--url', type=str, default=SITE_URL, help='Адрес, с которого начинается обход')
+    parser.add_argument('--max-pages', type=int, default=CRAWL_MAX_PAGES, help='Максимум страниц за обход')
+    parser.add_argument('--concurrency', type=int, default=CRAWL_CONCURRENCY, help='Одновременных запросов')
+    parser.add_argument('--delay', type=float, default=CRAWL_DELAY, help='Пауза между запросами (сек)')
+    parser.add_argument('--ingest', action='store_true', help='Сразу обновить базу знаний и индекс')
+    args = parser.parse_args()
+
+    crawler = SiteCrawler(args.data_dir, args.url, args.max_pages, args.concurrency, args.delay)
+    started = time.perf_counter()
+    stats = await crawler.crawl()
+    print(f"Обход завершен за {time.perf_counter() - started:.1f} с: страниц {stats['pages']}, "
+          f"загружено {stats['fetched']}, без изменений {stats['not_modified']}, "
+          f"сохранено {stats['saved']}, удалено {stats['removed']}, ошибок {stats['errors']}")
+
+    if args.ingest:
+        from data_loader import DataLoader
+        loader = DataLoader(args.data_dir)
+        await loader.process_directory()
+        print("База знаний обновлена")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
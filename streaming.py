@@ -0,0 +1,174 @@
+import asyncio
+import time
+from typing import AsyncIterator, List, Optional
+
+from aiogram.types import Message
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+# Лимит длины одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+# Запас под закрывающие символы Markdown
+SPLIT_LIMIT = TELEGRAM_MESSAGE_LIMIT - 96
+# Минимальный интервал между редактированиями одного сообщения (сек)
+EDIT_INTERVAL = 1.5
+PLACEHOLDER_TEXT = "✍️ Генерирую ответ..."
+CURSOR = " ▌"
+
+
+def balance_markdown(text: str) -> str:
+    """Close Markdown entities left open in a partially generated text."""
+    if text.count("```") % 2:
+        return text + "\n```"
+    # Вне блоков кода закрываем незакрытые выделения
+    outside_code = "".join(text.split("```")[::2])
+    closers = ""
+    if outside_code.count("`") % 2:
+        closers += "`"
+    else:
+        for marker in ("*", "_"):
+            if outside_code.count(marker) % 2:
+                closers += marker
+    return text + closers
+
+
+def find_split_point(text: str, limit: int = SPLIT_LIMIT) -> int:
+    """Find where to cut text for one message: paragraph, line, then word boundary."""
+    if len(text) <= limit:
+        return len(text)
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, limit)
+        if position > limit // 2:
+            return position + len(separator)
+    return limit
+
+
+def split_message(text: str, limit: int = SPLIT_LIMIT) -> List[str]:
+    """Split a long answer into parts that fit into Telegram messages."""
+    parts = []
+    while len(text) > limit:
+        cut = find_split_point(text, limit)
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
+
+async def send_markdown(message: Message, text: str):
+    """
+    Send text with Markdown, split into several messages if it is too long;
+    parts Telegram can't parse are sent as plain text.
+    """
+    for part in split_message(text):
+        try:
+            await message.answer(part, parse_mode="Markdown")
+        except TelegramBadRequest:
+            await message.answer(part)
+
+
+class StreamingReply:
+    """Progressively edits a placeholder message as answer text arrives."""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.current: Optional[Message] = None
+        self.text = ""
+        self.shown = ""
+        self.last_edit = 0.0
+        self.blocked_until = 0.0
+
+    async def _edit(self, text: str, final: bool = False) -> bool:
+        if not final and time.monotonic() < self.blocked_until:
+            return False
+        try:
+            if final:
+                try:
+                    await self.current.edit_text(text, parse_mode="Markdown")
+                except TelegramBadRequest as e:
+                    if "not modified" in str(e):
+                        return True
+                    await self.current.edit_text(text)
+            else:
+                await self.current.edit_text(balance_markdown(text) + CURSOR, parse_mode="Markdown")
+        except TelegramRetryAfter as e:
+            # Telegram просит подождать: пропускаем промежуточные правки
+            self.blocked_until = time.monotonic() + e.retry_after
+            if final:
+                await asyncio.sleep(e.retry_after)
+                return await self._edit(text, final)
+            return False
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return True
+            if final:
+                raise
+            # Незавершенная разметка не разобралась - показываем как обычный текст
+            try:
+                await self.current.edit_text(text + CURSOR)
+            except (TelegramBadRequest, TelegramRetryAfter):
+                return False
+        self.last_edit = time.monotonic()
+        self.shown = text
+        return True
+
+    async def start(self):
+        """Show a placeholder right away; the first received text replaces it immediately."""
+        self.current = await self.message.answer(PLACEHOLDER_TEXT)
+        self.last_edit = 0.0
+
+    async def feed(self, delta: str):
+        self.text += delta
+
+        # Текст не помещается в одно сообщение - завершаем текущее и начинаем новое
+        while len(self.text) > SPLIT_LIMIT:
+            cut = find_split_point(self.text)
+            head, self.text = self.text[:cut].rstrip(), self.text[cut:].lstrip()
+            await self._edit(head, final=True)
+            self.current = await self.message.answer(PLACEHOLDER_TEXT)
+            self.shown = ""
+
+        if self.text != self.shown and time.monotonic() - self.last_edit >= EDIT_INTERVAL:
+            await self._edit(self.text)
+
+    async def finish(self):
+        await self._edit(self.text.strip() or "Пустой ответ", final=True)
+
+
+async def stream_answer(message: Message, chunks: AsyncIterator[str]) -> str:
+    """Stream generated text into Telegram and return the full answer."""
+    reply = StreamingReply(message)
+    await reply.start()
+    parts = []
+    async for delta in chunks:
+        parts.append(delta)
+        await reply.feed(delta)
+    await reply.finish()
+    return "".join(parts)
+
+
+class QueueNotice:
+    """Message telling the user their place in the generation queue; removed once generation starts."""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.notice: Optional[Message] = None
+
+    async def update(self, position: int):
+        text = (f"⏳ Сейчас много запросов, ваш {position}-й в очереди. Ответ начнется автоматически, "
+                f"отменить - /reset.")
+        try:
+            if self.notice is None:
+                self.notice = await self.message.answer(text)
+            else:
+                await self.notice.edit_text(text)
+        except (TelegramBadRequest, TelegramRetryAfter):
+            pass
+
+    async def remove(self):
+        if self.notice is None:
+            return
+        try:
+            await self.notice.delete()
+        except (TelegramBadRequest, TelegramRetryAfter):
+            pass
+        self.notice = None
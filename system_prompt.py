@@ -10,6 +10,9 @@ SYSTEM_PROMPTS = {
     6. Всегда используй разделение на абзацы и красивое форматирование
     7. Если вопрос о конкретном продукте, используй общую ссылку на каталог: [Название продукта](https://ru.siberianhealth.com/ru/shop/?referral=2648699724)
     """,
+    "summary": """Сожми диалог пользователя с ассистентом компании Siberian Health в краткую сводку (не больше 5 предложений).
+    Сохрани: о каких продуктах, темах и целях шла речь, важные факты о пользователе, заданные вопросы и суть ответов.
+    Пиши только сводку, без вступлений.""",
 }
 
 def get_system_prompt(prompt_type: str = "default") -> str:
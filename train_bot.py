@@ -8,6 +8,12 @@ async def train_bot():
     parser = argparse.ArgumentParser(description='Обучение бота на данных.')
     parser.add_argument('--data-dir', type=str, default='training_data',
                       help='Директория с обучающими данными (по умолчанию: training_data)')
+    parser.add_argument('--embedder', type=str, default=None,
+                      help='Модель для эмбеддингов фрагментов: "hashing" или имя локальной '
+                           'модели sentence-transformers (по умолчанию: текущая или hashing)')
+    parser.add_argument('--jobs', type=int, default=None,
+                      help='Количество процессов для параллельной обработки файлов '
+                           '(по умолчанию: по числу ядер, не более 4)')
     
     args = parser.parse_args()
     
@@ -25,21 +31,35 @@ async def train_bot():
     
     # Инициализируем загрузчик данных
     loader = DataLoader(args.data_dir)
+    if args.embedder:
+        loader.embedder_name = args.embedder
     
     # Обрабатываем все файлы
-    knowledge_base = await loader.process_directory()
+    knowledge_base = await loader.process_directory(jobs=args.jobs)
+    
+    # Пересчитываем эмбеддинги, если хранилище векторов отсутствует или выбрана другая модель
+    if loader.vectors is None or loader.vectors.embedder.name != loader.embedder_name:
+        loader.build_vectors()
     
     # Выводим статистику
     pdf_count = sum(1 for _, data in knowledge_base.items() if data['type'] == 'pdf')
     img_count = sum(1 for _, data in knowledge_base.items() if data['type'] == 'image')
     text_count = sum(1 for _, data in knowledge_base.items() if data['type'] == 'text')
     
+    if loader.last_report:
+        print("\n=== Время обработки файлов ===")
+        for item in sorted(loader.last_report, key=lambda r: r['seconds'], reverse=True):
+            print(f"  {item['seconds']:8.2f} с  {item['status']:<8} {item['chars']:>8} симв.  {item['file']}")
+    else:
+        print("\nНовых или измененных файлов нет")
+    
     print("\n=== Результаты обработки ===")
     print(f"Обработано PDF файлов: {pdf_count}")
     print(f"Обработано изображений: {img_count}")
     print(f"Обработано текстовых файлов: {text_count}")
     print(f"Всего файлов в базе знаний: {len(knowledge_base)}")
-    print(f"\nБаза знаний сохранена в: {os.path.join(args.data_dir, 'knowledge_base.json')}")
+    print(f"\nБаза знаний сохранена в: {loader.db_file}")
+    print(f"Векторное хранилище: {loader.vector_file} ({loader.vectors.embedder.name})")
     print("\nТеперь бот готов отвечать на вопросы с использованием этих данных.")
 
 if __name__ == "__main__":
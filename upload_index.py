@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from data_loader import CHUNK_MAX_CHARS
+from search_index import SearchIndex, split_into_chunks
+from session_store import CONTEXT_TTL
+
+# Сколько индексов загруженных документов держать в памяти процесса
+UPLOAD_INDEX_CACHE_SIZE = 64
+# Сколько фрагментов загруженного документа передавать в модель
+UPLOAD_TOP_K = 6
+# Сколько фрагментов общей базы знаний добавлять к ним (0 - не добавлять)
+KNOWLEDGE_TOP_K = 2
+
+
+class UploadIndex:
+    """BM25 index over the chunks of one document uploaded by a user."""
+
+    def __init__(self, text: str, source: str):
+        self.source = source
+        self.chunks = split_into_chunks(text, CHUNK_MAX_CHARS)
+        self.index = SearchIndex.build((position, source, chunk) for position, chunk in enumerate(self.chunks))
+
+    def search(self, query: str, top_k: int = UPLOAD_TOP_K) -> List[Dict]:
+        """
+        Chunks relevant to the query. A short document is returned whole;
+        if no chunk matches, the beginning of the document is used.
+        """
+        if len(self.chunks) <= top_k:
+            ranked = [(position, 0.0) for position in range(len(self.chunks))]
+        else:
+            ranked = self.index.search(query, top_k) or [(position, 0.0) for position in range(top_k)]
+        return [
+            {"id": f"upload:{position}", "source": self.source, "text": self.chunks[position], "score": score}
+            for position, score in ranked
+        ]
+
+
+class UploadIndexCache:
+    """
+    LRU of upload indexes by context id. Entries expire together with the
+    stored document text; a missing index is rebuilt from ContextStore.
+    """
+
+    def __init__(self, max_entries: int = UPLOAD_INDEX_CACHE_SIZE, ttl: float = CONTEXT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, UploadIndex]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, context_id: Optional[str]) -> Optional[UploadIndex]:
+        if not context_id:
+            return None
+        with self._lock:
+            entry = self.entries.get(context_id)
+            if entry is None:
+                return None
+            created, index = entry
+            if time.time() - created > self.ttl:
+                del self.entries[context_id]
+                return None
+            self.entries.move_to_end(context_id)
+            return index
+
+    def put(self, context_id: str, index: UploadIndex):
+        with self._lock:
+            self.entries[context_id] = (time.time(), index)
+            self.entries.move_to_end(context_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, context_id: Optional[str]):
+        with self._lock:
+            self.entries.pop(context_id, None)
@@ -0,0 +1,201 @@
+import json
+import os
+import uuid
+import zlib
+import math
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from search_index import TOKEN_RE, STOP_WORDS, normalize_token
+
+# Модель по умолчанию для локальных эмбеддингов (нужен sentence-transformers)
+DEFAULT_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+HASHING_EMBEDDER = "hashing"
+
+
+class HashingVectorizer:
+    """
+    Dependency-free fallback embedder: hashed stems and character trigrams
+    with TF-IDF weighting, L2-normalized into a fixed-size float32 vector.
+    """
+
+    def __init__(self, dim: int = 1024, idf: Optional[List[float]] = None):
+        self.name = HASHING_EMBEDDER
+        self.dim = dim
+        self.idf = np.asarray(idf, dtype=np.float32) if idf is not None else None
+
+    def _features(self, text: str) -> List[Tuple[int, float]]:
+        features = []
+        for token in TOKEN_RE.findall(text.lower()):
+            if token in STOP_WORDS:
+                continue
+            stem = normalize_token(token)
+            features.append((zlib.crc32(stem.encode("utf-8")), 1.0))
+            # Триграммы символов помогают сопоставлять разные формы слова
+            padded = f"#{stem}#"
+            for i in range(len(padded) - 2):
+                features.append((zlib.crc32(padded[i:i + 3].encode("utf-8")), 0.5))
+        return features
+
+    def _raw(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for h, weight in self._features(text):
+            sign = 1.0 if (h >> 31) & 1 else -1.0
+            vector[h % self.dim] += sign * weight
+        # Сублинейное масштабирование частот
+        return np.sign(vector) * np.log1p(np.abs(vector))
+
+    def fit(self, texts: List[str]):
+        """Learn per-bucket IDF weights from the corpus."""
+        df = np.zeros(self.dim, dtype=np.float32)
+        for text in texts:
+            df += self._raw(text) != 0
+        self.idf = (np.log((len(texts) + 1) / (df + 1)) + 1).astype(np.float32)
+        return self
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        matrix = np.vstack([self._raw(text) for text in texts]) if texts else np.zeros((0, self.dim), np.float32)
+        if self.idf is not None:
+            matrix *= self.idf
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (matrix / norms).astype(np.float32)
+
+    def config(self) -> dict:
+        return {"dim": self.dim, "idf": self.idf.tolist() if self.idf is not None else None}
+
+
+class LocalModelEmbedder:
+    """CPU-only sentence-transformers model used when it is installed."""
+
+    def __init__(self, model_name: str = DEFAULT_MODEL):
+        from sentence_transformers import SentenceTransformer
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def fit(self, texts: List[str]):
+        return self
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        vectors = self.model.encode(texts, batch_size=32, normalize_embeddings=True,
+                                    convert_to_numpy=True, show_progress_bar=False)
+        return np.ascontiguousarray(vectors, dtype=np.float32)
+
+    def config(self) -> dict:
+        return {"dim": self.dim}
+
+
+def create_embedder(name: str = HASHING_EMBEDDER, config: Optional[dict] = None):
+    """Create an embedder by name, falling back to hashing if the model is unavailable."""
+    config = config or {}
+    if name != HASHING_EMBEDDER:
+        try:
+            return LocalModelEmbedder(name)
+        except Exception as e:
+            print(f"Local embedding model {name} is unavailable ({str(e)}), using hashing vectorizer")
+    return HashingVectorizer(config.get("dim", 1024), config.get("idf"))
+
+
+class VectorStore:
+    """
+    Chunk embeddings stored as a contiguous float32 matrix in a .npy file.
+    The matrix is memory-mapped on load, so several bot processes
+    share a single copy of it in the page cache.
+    """
+
+    def __init__(self, vectors: np.ndarray, embedder):
+        self.vectors = vectors
+        self.embedder = embedder
+
+    @staticmethod
+    def meta_path(path: str) -> str:
+        return os.path.splitext(path)[0] + ".json"
+
+    @classmethod
+    def build(cls, texts: List[str], path: str, embedder_name: str = HASHING_EMBEDDER,
+              index_version: Optional[str] = None) -> "VectorStore":
+        """
+        Embed all chunks and save the matrix together with embedder metadata
+        and the version of the search index the rows are aligned with.
+        """
+        embedder = create_embedder(embedder_name).fit(texts)
+        vectors = embedder.encode(texts)
+        if vectors.shape[0] == 0:
+            vectors = np.zeros((0, embedder.dim), dtype=np.float32)
+
+        # Уникальные временные имена: векторы могут одновременно строиться в двух местах
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp.npy"
+        np.save(tmp_path, np.ascontiguousarray(vectors, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+        meta = {"embedder": embedder.name, "count": len(texts), "index_version": index_version,
+                "config": embedder.config()}
+        meta_tmp_path = f"{cls.meta_path(path)}.{uuid.uuid4().hex}.tmp"
+        with open(meta_tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(meta_tmp_path, cls.meta_path(path))
+        return cls(vectors, embedder)
+
+    @classmethod
+    def load(cls, path: str, expected_count: Optional[int] = None,
+             index_version: Optional[str] = None) -> Optional["VectorStore"]:
+        """Memory-map the store; return None if it is missing or out of sync with the index."""
+        meta_path = cls.meta_path(path)
+        if not (os.path.exists(path) and os.path.exists(meta_path)):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        # Индекс и векторы сохраняются по отдельности: после сбоя или параллельной перестройки
+        # между ними строки векторов могут относиться к другим фрагментам при том же их числе
+        if ((expected_count is not None and meta.get("count") != expected_count)
+                or (index_version is not None and meta.get("index_version") != index_version)):
+            print("Vector store is out of sync with the search index, ignoring it")
+            return None
+        vectors = np.load(path, mmap_mode='r')
+        if meta["embedder"] == HASHING_EMBEDDER:
+            return cls(vectors, create_embedder(HASHING_EMBEDDER, meta.get("config")))
+        # Запросы нельзя кодировать другой моделью: векторы окажутся в другом пространстве
+        try:
+            embedder = LocalModelEmbedder(meta["embedder"])
+        except Exception as e:
+            print(f"Embedding model {meta['embedder']} the vectors were built with is unavailable "
+                  f"({str(e)}), vector search is disabled")
+            return None
+        return cls(vectors, embedder)
+
+    @staticmethod
+    def read_embedder_name(path: str) -> Optional[str]:
+        meta_path = VectorStore.meta_path(path)
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f).get("embedder")
+
+    def encode_query(self, query: str) -> np.ndarray:
+        return self.embedder.encode([query])[0]
+
+    def scores(self, query_vector: np.ndarray, ids: Optional[List[int]] = None) -> np.ndarray:
+        """Cosine similarities of the query to all chunks (or to the given chunk ids)."""
+        matrix = self.vectors if ids is None else self.vectors[ids]
+        return matrix @ query_vector
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[int, float]]:
+        """Return (chunk_id, similarity) pairs of the nearest chunks."""
+        return self.search_vector(self.encode_query(query), top_k)
+
+    def search_vector(self, query_vector: np.ndarray, top_k: int = 5) -> List[Tuple[int, float]]:
+        if len(self.vectors) == 0:
+            return []
+        return self.top_scores(self.scores(query_vector), top_k)
+
+    @staticmethod
+    def top_scores(scores: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        """(chunk_id, similarity) pairs of the top_k positive scores, best first."""
+        if len(scores) == 0:
+            return []
+        top_k = min(top_k, len(scores))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if scores[i] > 0 and not math.isnan(scores[i])]
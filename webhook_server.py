@@ -0,0 +1,253 @@
+import os
+import json
+import signal
+import asyncio
+import logging
+import multiprocessing
+from typing import Dict, List, Optional
+
+import aiohttp
+from aiohttp import web
+
+from data_loader import DataLoader
+from document_processor import DocumentProcessor
+import document_processor
+from kb_watcher import KnowledgeWatcher, SnapshotWatcher
+from metrics import (METRICS_PORT, HandlerMetricsMiddleware, TelegramRequestMetrics,
+                     start_metrics_server)
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес, на который Telegram отправляет обновления (например, https://bot.example.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Секрет, который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+# Количество процессов-обработчиков
+WORKER_COUNT = min(4, os.cpu_count() or 1)
+# Обработчики слушают 127.0.0.1 на портах WORKER_BASE_PORT, WORKER_BASE_PORT + 1, ...
+WORKER_BASE_PORT = 8081
+WORKER_PATH = "/update"
+# Сколько ждать передачи обновления обработчику (сек)
+FORWARD_TIMEOUT = 10
+# Сколько ждать завершения начатых обработок при остановке (сек)
+DRAIN_TIMEOUT = 30
+# Как часто проверять, что процессы-обработчики живы (сек)
+WORKER_CHECK_INTERVAL = 5
+DATA_DIR = "training_data"
+
+
+def chat_id_of(update: Dict) -> int:
+    """Chat an update belongs to; used to route all updates of a chat to the same worker."""
+    for key, value in update.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return chat["id"]
+        sender = value.get("from")
+        if sender and "id" in sender:
+            return sender["id"]
+    return update.get("update_id", 0)
+
+
+def worker_for(chat_id: int, worker_count: int) -> int:
+    return abs(chat_id) % worker_count
+
+
+def _stop_event() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+
+# --- Процесс-обработчик ---
+
+async def _worker_main(index: int, port: int, worker_count: int):
+    from aiogram import Bot, Dispatcher
+    from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+    from config import TG_TOKEN
+    import generate
+    from handlers import router, init_stores, set_data_loader, generation_scheduler
+    from scheduler import MAX_CONCURRENT_GENERATIONS
+    from session_store import SQLiteStorage
+
+    # Процессы для PDF и OCR, лимит одновременных генераций и лимиты запросов к OpenRouter
+    # делятся между обработчиками, чтобы все вместе не превышали лимиты одного процесса
+    DocumentProcessor.configure(max_workers=max(1, document_processor.MAX_WORKERS // worker_count))
+    generation_scheduler.configure(max(1, MAX_CONCURRENT_GENERATIONS // worker_count))
+    generate.client.configure(max(1, generate.MAX_IN_FLIGHT // worker_count),
+                              generate.RATE_PER_SECOND / worker_count)
+
+    init_stores()
+
+    # Индекс уже построен супервизором: читаем снимок, векторы отображаются в память
+    set_data_loader(await asyncio.to_thread(DataLoader, DATA_DIR))
+    watcher = SnapshotWatcher(DATA_DIR, set_data_loader)
+    watcher.start()
+
+    bot = Bot(token=TG_TOKEN)
+    # Состояния диалогов общие для всех обработчиков и переживают их перезапуск
+    dp = Dispatcher(storage=SQLiteStorage())
+    dp.include_router(router)
+    router.message.middleware(HandlerMetricsMiddleware())
+    bot.session.middleware(TelegramRequestMetrics())
+    metrics_runner = await start_metrics_server(port=METRICS_PORT + index + 1 if METRICS_PORT else 0)
+
+    request_handler = SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True)
+    app = web.Application()
+    request_handler.register(app, path=WORKER_PATH)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", port)
+    await site.start()
+    logger.info(f"Обработчик {index} слушает 127.0.0.1:{port}")
+
+    await _stop_event().wait()
+
+    # Больше не принимаем обновления и ждем обработки уже полученных
+    await site.stop()
+    pending = set(request_handler._background_feed_update_tasks)
+    if pending:
+        logger.info(f"Обработчик {index}: завершение {len(pending)} начатых обработок")
+        await asyncio.wait(pending, timeout=DRAIN_TIMEOUT)
+    await runner.cleanup()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    await watcher.stop()
+    await dp.storage.close()
+    DocumentProcessor.shutdown()
+    logger.info(f"Обработчик {index} остановлен")
+
+
+def run_worker(index: int, port: int, worker_count: int):
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(_worker_main(index, port, worker_count))
+
+
+# --- Супервизор: прием вебхука и распределение по обработчикам ---
+
+class WebhookSupervisor:
+    """
+    Accepts Telegram webhooks and forwards every update to the worker process
+    that owns its chat, so FSM state of a chat always lives in one process.
+    Workers are restarted if they die and are drained on shutdown.
+    """
+
+    def __init__(self, worker_count: int = WORKER_COUNT):
+        self.worker_count = worker_count
+        self.context = multiprocessing.get_context("spawn")
+        self.workers: List[Optional[multiprocessing.Process]] = [None] * worker_count
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.stopping = False
+
+    def start_worker(self, index: int):
+        process = self.context.Process(
+            target=run_worker, args=(index, WORKER_BASE_PORT + index, self.worker_count),
+            name=f"bot-worker-{index}", daemon=False
+        )
+        process.start()
+        self.workers[index] = process
+
+    async def monitor_workers(self):
+        while not self.stopping:
+            await asyncio.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(self.workers):
+                if not self.stopping and process is not None and not process.is_alive():
+                    logger.error(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапуск")
+                    self.start_worker(index)
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+
+        index = worker_for(chat_id_of(update), self.worker_count)
+        url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}{WORKER_PATH}"
+        try:
+            async with self.session.post(url, data=body, headers={"Content-Type": "application/json"}) as response:
+                return web.Response(status=response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Telegram повторит доставку обновления позже
+            logger.warning(f"Обработчик {index} недоступен: {e}")
+            return web.Response(status=503)
+
+    async def stop_workers(self):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                await asyncio.to_thread(process.join, DRAIN_TIMEOUT + 5)
+                if process.is_alive():
+                    logger.warning(f"{process.name} не завершился вовремя, принудительная остановка")
+                    process.kill()
+
+    async def run(self):
+        from aiogram import Bot
+        from config import TG_TOKEN
+        from handlers import Gen
+        from session_store import SQLiteStorage
+
+        # Генерации, прерванные остановкой бота, уже не завершатся
+        storage = SQLiteStorage()
+        storage.reset_state(Gen.wait.state)
+        await storage.close()
+
+        # Файлы обрабатываются один раз на хост; обработчики только читают снимок индекса
+        logger.info("Загрузка базы знаний...")
+        loader = DataLoader(DATA_DIR)
+        await loader.process_directory()
+        loader.store.close()
+        logger.info("База знаний загружена")
+
+        for index in range(self.worker_count):
+            self.start_worker(index)
+        monitor = asyncio.create_task(self.monitor_workers())
+        watcher = KnowledgeWatcher(DATA_DIR, lambda new_loader: new_loader.store.close())
+        watcher.start()
+        metrics_runner = await start_metrics_server()
+
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=FORWARD_TIMEOUT))
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+        if WEBHOOK_URL:
+            bot = Bot(token=TG_TOKEN)
+            try:
+                await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+            finally:
+                await bot.session.close()
+        logger.info(f"Вебхук слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, обработчиков: {self.worker_count}")
+
+        try:
+            await _stop_event().wait()
+        finally:
+            # Вебхук не удаляем: пока бот остановлен, Telegram копит обновления
+            logger.info("Остановка: завершаем прием обновлений")
+            self.stopping = True
+            monitor.cancel()
+            await runner.cleanup()
+            await self.session.close()
+            await self.stop_workers()
+            await watcher.stop()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            DocumentProcessor.shutdown()
+            logger.info("Бот остановлен")
+
+
+def serve(worker_count: int = WORKER_COUNT):
+    asyncio.run(WebhookSupervisor(worker_count).run())